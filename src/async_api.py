@@ -0,0 +1,215 @@
+import asyncio
+import itertools
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from engine_registry import get_engine
+from search import BeamSearch
+from cancellation import CancelToken
+
+#asyncio front end for one loaded model. all inference runs on a single dedicated thread that
+#serves the queued calls of every client (a search or a plain request) round robin, so concurrent
+#searches share the model fairly and a long search cannot starve short requests.
+#the search logic itself is synchronous: each running search occupies one thread of a bounded
+#pool (max_searches) that blocks on its engine calls, extra searches wait for a free slot
+#without a thread of their own
+
+class InferenceScheduler:
+    def __init__(self):
+        #client -> queued jobs, in round robin order
+        self.queues = OrderedDict()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name="inference", daemon=True)
+        self.thread.start()
+
+    def submit(self, client, fn, *args, **kwargs):
+        future = Future()
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("inference scheduler is closed")
+            self.queues.setdefault(client, deque()).append((future, fn, args, kwargs))
+            self.cond.notify()
+        return future
+
+    def pending(self):
+        with self.cond:
+            return sum(len(jobs) for jobs in self.queues.values())
+
+    def _next(self):
+        with self.cond:
+            while not self.queues and not self.closed:
+                self.cond.wait()
+            if not self.queues:
+                return None
+            client, jobs = self.queues.popitem(last=False)
+            job = jobs.popleft()
+            #the client goes to the back of the line
+            if jobs:
+                self.queues[client] = jobs
+            return job
+
+    def _run(self):
+        while True:
+            job = self._next()
+            if job is None:
+                return
+            future, fn, args, kwargs = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def close(self):
+        #queued jobs are still served, new ones are refused
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class ScheduledEngine:
+    #engine interface for a search running on its own thread: every call is queued on the scheduler
+    #under one client id and waited for. usage only counts this client's calls, so search budgets
+    #(MCTSSearch) are not charged for concurrent searches
+    def __init__(self, async_engine, client, history=None):
+        engine = async_engine.engine
+        self.async_engine = async_engine
+        self.client = client
+        self.history = list(engine.history if history is None else history)
+        self.context_length = engine.context_length
+        self.answer_length = engine.answer_length
+        self.model_path = getattr(engine, "model_path", None)
+        self.tracer = getattr(engine, "tracer", None)
+        self.usage = {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+    def _call(self, name, *args, **kwargs):
+        return self.async_engine.scheduler.submit(self.client, self._run, name, args, kwargs).result()
+
+    def _run(self, name, args, kwargs):
+        #runs on the inference thread, one call at a time, so the usage delta is this call's
+        engine = self.async_engine.engine
+        before = dict(engine.usage)
+        try:
+            return getattr(engine, name)(*args, **kwargs)
+        finally:
+            for key in self.usage:
+                self.usage[key] += engine.usage[key] - before[key]
+
+    def generate_answer(self, *args, **kwargs):
+        return self._call("generate_answer", *args, **kwargs)
+
+    def generate_batch(self, *args, **kwargs):
+        return self._call("generate_batch", *args, **kwargs)
+
+    def score_logprobs(self, *args, **kwargs):
+        return self._call("score_logprobs", *args, **kwargs)
+
+    def cache_prefix(self, *args, **kwargs):
+        return self._call("cache_prefix", *args, **kwargs)
+
+    def count_tokens(self, *args, **kwargs):
+        return self._call("count_tokens", *args, **kwargs)
+
+
+class AsyncChatEngine:
+    def __init__(self, engine=None, max_searches=8, **engine_kwargs):
+        #wraps an existing engine (ChatEngine, StubEngine, ...) or the shared ChatEngine for engine_kwargs
+        self.engine = engine if engine is not None else get_engine(**engine_kwargs)
+        self.scheduler = InferenceScheduler()
+        self.search_executor = ThreadPoolExecutor(max_workers=max_searches, thread_name_prefix="search")
+        self.clients = itertools.count()
+
+    @property
+    def history(self):
+        return self.engine.history
+
+    async def run(self, fn, *args, client=None, **kwargs):
+        #runs fn(*args, **kwargs) on the inference thread. calls without a client id are
+        #each their own client, so a burst of them is interleaved with running searches
+        if client is None:
+            client = ("call", next(self.clients))
+        return await asyncio.wrap_future(self.scheduler.submit(client, fn, *args, **kwargs))
+
+    async def generate_answer(self, context, client=None, **kwargs):
+        return await self.run(self.engine.generate_answer, context, client=client, **kwargs)
+
+    async def generate_batch(self, contexts, client=None, **kwargs):
+        return await self.run(self.engine.generate_batch, contexts, client=client, **kwargs)
+
+    async def score_logprobs(self, context, client=None, **kwargs):
+        return await self.run(self.engine.score_logprobs, context, client=client, **kwargs)
+
+    async def cache_prefix(self, messages, client=None):
+        return await self.run(self.engine.cache_prefix, messages, client=client)
+
+    async def stream(self, context, client=None, **kwargs):
+        #async iterator over the text pieces of one answer. leaving the loop early cancels the generation
+        loop = asyncio.get_running_loop()
+        pieces = asyncio.Queue()
+        cancel = CancelToken()
+        on_token = lambda piece: loop.call_soon_threadsafe(pieces.put_nowait, piece)
+        call = asyncio.ensure_future(self.generate_answer(context, client=client, cancel=cancel,
+                                                          on_token=on_token, **kwargs))
+        call.add_done_callback(lambda _: pieces.put_nowait(None))
+        try:
+            while True:
+                piece = await pieces.get()
+                if piece is None:
+                    break
+                yield piece
+            await call
+        finally:
+            cancel.cancel()
+
+    def close(self):
+        self.scheduler.close()
+        self.search_executor.shutdown(wait=False)
+
+
+class AsyncBeamSearch:
+    def __init__(self, engine, search_class=BeamSearch, history=None, **search_kwargs):
+        #engine is an AsyncChatEngine. search_kwargs go to search_class (BeamSearch, MCTSSearch)
+        self.engine = engine
+        self.search_class = search_class
+        self.history = history
+        self.search_kwargs = search_kwargs
+        self.searcher = None
+
+    async def search(self, question):
+        async for event, payload in self.events(question):
+            if event == "done":
+                return payload["result"]
+
+    async def events(self, question):
+        #async iterator over the search events (node_added, score_updated, expanded, beam_selected,
+        #solution, token {text}), ending with done {result}. a failed search raises here, and
+        #leaving the loop early cancels the search
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        cancel = CancelToken()
+        emit = lambda event, payload: loop.call_soon_threadsafe(events.put_nowait, (event, payload))
+        client = ("search", next(self.engine.clients))
+        engine = ScheduledEngine(self.engine, client, self.history)
+        self.searcher = self.search_class(engine=engine, cancel_token=cancel, on_event=emit,
+                                          on_token=lambda piece: emit("token", {"text": piece}),
+                                          **self.search_kwargs)
+
+        def run():
+            try:
+                emit("done", {"result": self.searcher.search(question), "usage": dict(engine.usage)})
+            except BaseException as e:
+                emit("error", {"error": e})
+
+        self.engine.search_executor.submit(run)
+        try:
+            while True:
+                event, payload = await events.get()
+                if event == "error":
+                    raise payload["error"]
+                yield event, payload
+                if event == "done":
+                    return
+        finally:
+            cancel.cancel()
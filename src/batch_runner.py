@@ -0,0 +1,331 @@
+import argparse
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from modes import MODES
+from benchmark import BENCHMARK_DIR, is_solved, load_corpus, run_question
+from stub_engine import StubEngine
+
+#headless batch runner: reads questions from JSONL, runs many searches at once on one model and
+#appends one JSONL record per question (answer, usage, wall time). records are written as soon as a
+#question finishes, so an interrupted batch resumes where it stopped.
+#  python batch_runner.py questions.jsonl results.jsonl --mode thinking --concurrency 8
+#  python batch_runner.py ../benchmarks/puzzles.jsonl results.jsonl --engine stub
+#input lines are {"id": ..., "question": ..., "mode": optional, "answer": optional [substrings]}
+#
+#every search runs on its own thread and blocks on its engine calls. a single dispatcher thread
+#serves those calls: while all running searches are waiting on the model (or after max_wait), it
+#merges the queued generate_answer calls that share their sampling params into one generate_batch,
+#so expansions and text grades of different questions are decoded together. a batch holds as many
+#calls as fit the engine's context window together (--n-ctx), a call that fits with no other runs
+#alone, with its grammar. other calls (logprob scores, cache_prefix, ...) are served one at a time
+#in arrival order.
+
+#generate_answer params that generate_batch understands. calls with anything else run alone
+BATCH_PARAMS = {"answer_length", "temperature", "top_k", "top_p", "min_p", "repeat_penalty", "stop"}
+#labels and callbacks, not sampling params
+CALL_ONLY = {"phase", "depth", "cancel", "on_token", "seed"}
+#calls that run the model, the others only tokenize or restore a cached prefix
+GENERATION_CALLS = {"generate_answer", "generate_batch", "score_logprobs"}
+
+class BatchScheduler:
+    def __init__(self, engine, max_batch=8, max_wait=0.01, relax_grammar=True):
+        self.engine = engine
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        #the batched sampler cannot apply a grammar. with relax_grammar, constrained calls are batched
+        #anyway and the format is enforced by rejection (StepFilter, score parsing), as in sample_parallel.
+        #calls that end up running alone keep their grammar
+        self.relax_grammar = relax_grammar
+        self.pending = []
+        self.active = 0
+        self.cond = threading.Condition()
+        self.closed = False
+        #calls counts generation calls only
+        self.stats = {"calls": 0, "batches": 0, "batched_calls": 0}
+        self.thread = threading.Thread(target=self._run, name="dispatcher", daemon=True)
+        self.thread.start()
+
+    def client(self, history=None):
+        with self.cond:
+            self.active += 1
+        return BatchClient(self, history)
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify()
+
+    def _key(self, name, args, kwargs):
+        #calls with the same key can share one generate_batch
+        if name != "generate_answer" or len(args) != 1:
+            return None
+        if kwargs.get("grammar") is not None and not self.relax_grammar:
+            return None
+        params = {k: v for k, v in kwargs.items() if k not in CALL_ONLY and k != "grammar"}
+        if not set(params) <= BATCH_PARAMS:
+            return None
+        return repr(sorted(params.items()))
+
+    def submit(self, client, name, args, kwargs):
+        future = Future()
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("batch scheduler is closed")
+            self.pending.append((future, client, name, args, kwargs, self._key(name, args, kwargs)))
+            self.cond.notify()
+        return future
+
+    def _take(self):
+        with self.cond:
+            while not self.pending and not self.closed:
+                self.cond.wait()
+            if not self.pending:
+                return None
+            #give the other searches a moment to queue their calls, unless all of them already did
+            deadline = time.perf_counter() + self.max_wait
+            while len(self.pending) < self.active and not self.closed:
+                left = deadline - time.perf_counter()
+                if left <= 0:
+                    break
+                self.cond.wait(left)
+            key = self.pending[0][5]
+            if key is None:
+                return [self.pending.pop(0)]
+            group = [job for job in self.pending if job[5] == key][:self.max_batch]
+            taken = {id(job[0]) for job in group}
+            self.pending = [job for job in self.pending if id(job[0]) not in taken]
+            return group
+
+    def _run(self):
+        while True:
+            group = self._take()
+            if group is None:
+                return
+            if len(group) > 1:
+                group = self._fit(group)
+            group = [job for job in group if job[0].set_running_or_notify_cancel()]
+            if len(group) == 1:
+                self._run_single(group[0])
+            elif group:
+                self._run_batch(group)
+
+    def _fit(self, group):
+        #the leading calls of the group whose batch fits the context window, the others are queued
+        #again. generate_batch would otherwise decode them one by one, without their grammars
+        contexts = [job[3][0] for job in group]
+        answer_length = group[0][4].get("answer_length")
+        count = 1
+        while (count < len(group) and
+               self.engine.batch_tokens(contexts[:count + 1], answer_length) <= self.engine.context_length):
+            count += 1
+        if count < len(group):
+            with self.cond:
+                self.pending[:0] = group[count:]
+        return group[:count]
+
+    def _run_single(self, job):
+        future, client, name, args, kwargs, _ = job
+        before = dict(self.engine.usage)
+        try:
+            future.set_result(getattr(self.engine, name)(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            #one call at a time, so the usage delta is this call's
+            client.charge({key: self.engine.usage[key] - before[key] for key in client.usage})
+            if name in GENERATION_CALLS:
+                self.stats["calls"] += 1
+
+    def _run_batch(self, group):
+        live = []
+        for job in group:
+            cancel = job[4].get("cancel")
+            try:
+                if cancel is not None:
+                    cancel.check()
+                live.append(job)
+            except BaseException as e:
+                job[0].set_exception(e)
+        if not live:
+            return
+        kwargs = live[0][4]
+        params = {k: v for k, v in kwargs.items() if k in BATCH_PARAMS}
+        before = dict(self.engine.usage)
+        try:
+            outputs = self.engine.generate_batch([job[3][0] for job in live], phase=kwargs.get("phase"), **params)
+        except BaseException as e:
+            for job in live:
+                job[0].set_exception(e)
+            return
+        delta = {key: self.engine.usage[key] - before[key] for key in before}
+        self.stats["calls"] += len(live)
+        self.stats["batches"] += 1
+        self.stats["batched_calls"] += len(live)
+        for i, (job, output) in enumerate(zip(live, outputs)):
+            future, client, _, _, kwargs, _ = job
+            usage = (output or {}).get("usage")
+            if usage:
+                client.charge({"calls": 1, "prompt_tokens": usage["prompt_tokens"],
+                               "completion_tokens": usage["completion_tokens"]})
+            else:
+                #no per-sequence usage, split the batch evenly (remainder to the first calls)
+                client.charge({key: value // len(live) + (i < value % len(live)) for key, value in delta.items()})
+            on_token = kwargs.get("on_token")
+            if output and on_token is not None:
+                on_token(output["choices"][0]["message"]["content"])
+            future.set_result(output)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+
+
+class BatchClient:
+    #engine interface for one search: calls are queued on the scheduler and waited for, usage only
+    #counts this search's calls. tracer is left unset so concurrent searches do not print summaries
+    #of each other's calls (the engine still traces every call)
+    def __init__(self, scheduler, history=None):
+        engine = scheduler.engine
+        self.scheduler = scheduler
+        self.history = list(engine.history if history is None else history)
+        self.context_length = engine.context_length
+        self.answer_length = engine.answer_length
+        self.model_path = getattr(engine, "model_path", None)
+        self.tracer = None
+        self.usage = {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+    def charge(self, usage):
+        for key in self.usage:
+            self.usage[key] += usage.get(key, 0)
+
+    def _call(self, name, *args, **kwargs):
+        return self.scheduler.submit(self, name, args, kwargs).result()
+
+    def generate_answer(self, *args, **kwargs):
+        return self._call("generate_answer", *args, **kwargs)
+
+    def generate_batch(self, *args, **kwargs):
+        return self._call("generate_batch", *args, **kwargs)
+
+    def score_logprobs(self, *args, **kwargs):
+        return self._call("score_logprobs", *args, **kwargs)
+
+    def cache_prefix(self, *args, **kwargs):
+        return self._call("cache_prefix", *args, **kwargs)
+
+    def count_tokens(self, *args, **kwargs):
+        return self._call("count_tokens", *args, **kwargs)
+
+    def close(self):
+        self.scheduler.release()
+
+
+def resolve_mode(name):
+    #accepts the GUI label or just its word ("thinking", "MCTS")
+    for mode_name in MODES:
+        if name == mode_name or name.lower() == mode_name.split()[-1].lower():
+            return mode_name
+    raise ValueError(f"unknown mode {name!r}, expected one of: {', '.join(MODES)}")
+
+def load_done(path):
+    #ids that already have a successful record
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                #a line cut off by an interrupted run
+                continue
+            if record.get("status") == "ok":
+                done.add(record["id"])
+    return done
+
+def run_item(scheduler, item, mode_name):
+    engine = scheduler.client()
+    start = time.perf_counter()
+    record = {"id": item["id"], "mode": mode_name, "question": item["question"]}
+    try:
+        text = run_question(engine, MODES[mode_name], item["question"])
+        record.update(status="ok", answer=text)
+        if item.get("answer"):
+            record["correct"] = is_solved(item, text)
+    except Exception as e:
+        record.update(status="error", error=f"{type(e).__name__}: {e}")
+    finally:
+        engine.close()
+    record["usage"] = dict(engine.usage)
+    record["wall_s"] = round(time.perf_counter() - start, 3)
+    return record
+
+def run_batch(engine, items, output_path, mode_name, concurrency=8, max_batch=8, max_wait=0.01,
+              relax_grammar=True, verbose=False):
+    done = load_done(output_path)
+    todo = [item for item in items if item["id"] not in done]
+    if done:
+        print(f"resuming: {len(items) - len(todo)} of {len(items)} questions already done", file=sys.stderr)
+    scheduler = BatchScheduler(engine, max_batch=max_batch, max_wait=max_wait, relax_grammar=relax_grammar)
+    totals = {"ok": 0, "error": 0}
+    start = time.perf_counter()
+    #search progress is printed from many threads at once, keep it out of the way unless asked for
+    with open(output_path, "a", encoding="utf-8") as out, open(os.devnull, "w") as devnull, \
+            contextlib.redirect_stdout(sys.stdout if verbose else devnull), \
+            ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="search") as pool:
+        futures = [pool.submit(run_item, scheduler, item, resolve_mode(item.get("mode") or mode_name))
+                   for item in todo]
+        for future in as_completed(futures):
+            record = future.result()
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            totals[record["status"]] += 1
+            print(f"[{sum(totals.values())}/{len(todo)}] {record['id']}: {record['status']} "
+                  f"({record['usage']['calls']} calls, {record['wall_s']}s)", file=sys.stderr)
+    scheduler.close()
+    stats = scheduler.stats
+    print(f"{totals['ok']} done, {totals['error']} failed in {time.perf_counter() - start:.1f}s; "
+          f"{stats['calls']} generation calls, {stats['batched_calls']} of them in {stats['batches']} batches",
+          file=sys.stderr)
+    return totals
+
+def main():
+    parser = argparse.ArgumentParser(description="Run reasoning searches over a JSONL file of questions")
+    parser.add_argument("input", help="JSONL with one {\"id\", \"question\"} object per line")
+    parser.add_argument("output", help="JSONL results, appended to; finished ids are skipped on rerun")
+    parser.add_argument("--mode", default="thinking", help="default mode for lines without one")
+    parser.add_argument("--engine", choices=["stub", "gguf"], default="gguf")
+    parser.add_argument("--model", help="path to a GGUF model")
+    parser.add_argument("--corpus", default=os.path.join(BENCHMARK_DIR, "puzzles.jsonl"),
+                        help="scripted puzzles for the stub engine")
+    parser.add_argument("--concurrency", type=int, default=8, help="searches running at once")
+    parser.add_argument("--max-batch", type=int, default=8, help="calls merged into one batched decode")
+    parser.add_argument("--max-wait", type=float, default=0.01, help="seconds to wait for calls to batch")
+    parser.add_argument("--strict-grammar", action="store_true", help="never batch grammar-constrained calls")
+    parser.add_argument("--n-ctx", type=int, default=16384,
+                        help="model context window, shared by the calls of a batch (gguf engine)")
+    parser.add_argument("--verbose", action="store_true", help="show the search output")
+    args = parser.parse_args()
+
+    items = load_corpus(args.input)
+    for index, item in enumerate(items):
+        item.setdefault("id", index)
+    if args.engine == "stub" and not args.model:
+        engine = StubEngine(load_corpus(args.corpus))
+    else:
+        from chat_engine import ChatEngine
+        engine = ChatEngine(context_length=args.n_ctx, **({"model_path": args.model} if args.model else {}))
+    totals = run_batch(engine, items, args.output, resolve_mode(args.mode), concurrency=args.concurrency,
+                       max_batch=args.max_batch, max_wait=args.max_wait, relax_grammar=not args.strict_grammar,
+                       verbose=args.verbose)
+    return 1 if totals["error"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,167 @@
+import argparse
+import contextlib
+import functools
+import io
+import json
+import os
+import sys
+import time
+from stub_engine import StubEngine
+from modes import MODES, make_searcher
+from engine_pool import EnginePool
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+#offline benchmark: runs every reasoning mode over a puzzle corpus and reports LLM calls, tokens,
+#wall time, peak memory and solve rate. with the stub engine the calls and tokens are exactly
+#reproducible, so a change in search logic shows up as a diff against the stored baseline.
+#  python benchmark.py                          (stub engine, compare against the baseline)
+#  python benchmark.py --write-baseline         (store the current numbers as the baseline)
+#  python benchmark.py --engine gguf --model ../models/model.gguf
+#  python benchmark.py --replicas 4 --stub-delay 0.01   (parallel beam layers on 4 engine processes)
+
+BENCHMARK_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+#metrics that fail the run when they get worse by more than the tolerance.
+#wall time and memory are reported only, they depend on the machine
+CHECKED = ("calls", "prompt_tokens", "completion_tokens", "solve_rate")
+
+def load_corpus(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #bytes on macOS, kilobytes elsewhere
+    return round(peak / (1 << 20 if sys.platform == "darwin" else 1 << 10), 1)
+
+def is_solved(puzzle, text):
+    text = text.lower()
+    return all(part.lower() in text for part in puzzle["answer"])
+
+def run_question(engine, config, question):
+    #same calls as the GUI makes for each mode
+    if config["type"] == "direct":
+        response = engine.generate_answer(engine.history + [{"role": "user", "content": question}], temperature=0.7,
+                                          phase="flash")
+        return response['choices'][0]['message']['content'] if response else ""
+    result = make_searcher(config, engine).search(question)
+    #result is [question, step, ..., solution]
+    return "\n".join(msg["content"] for msg in result[1:])
+
+def run_mode(engine, mode_name, corpus, verbose=False):
+    config = MODES[mode_name]
+    before = dict(engine.usage)
+    solved = 0
+    start = time.perf_counter()
+    for puzzle in corpus:
+        output = io.StringIO()
+        with contextlib.redirect_stdout(sys.stdout if verbose else output):
+            text = run_question(engine, config, puzzle["question"])
+        if is_solved(puzzle, text):
+            solved += 1
+    result = {key: engine.usage[key] - before[key] for key in before}
+    result["wall_s"] = round(time.perf_counter() - start, 3)
+    result["peak_rss_mb"] = peak_rss_mb()
+    result["solve_rate"] = round(solved / len(corpus), 3) if corpus else 0.0
+    return result
+
+def compare(results, baseline, tolerance):
+    #returns a list of regressions, "mode: metric old -> new"
+    regressions = []
+    for mode_name, result in results.items():
+        old = baseline.get(mode_name)
+        if not old:
+            continue
+        for metric in CHECKED:
+            if metric not in old:
+                continue
+            if metric == "solve_rate":
+                #absolute, the rate is already a fraction
+                worse = old[metric] - result[metric] > tolerance
+            else:
+                worse = result[metric] > old[metric] * (1 + tolerance)
+            if worse:
+                regressions.append(f"{mode_name}: {metric} {old[metric]} -> {result[metric]}")
+    return regressions
+
+def print_table(results, baseline):
+    columns = ["calls", "prompt_tokens", "completion_tokens", "wall_s", "peak_rss_mb", "solve_rate"]
+    print(f"{'mode':<14}" + "".join(f"{column:>19}" for column in columns))
+    for mode_name, result in results.items():
+        old = baseline.get(mode_name, {})
+        row = f"{mode_name:<14}"
+        for column in columns:
+            value = result[column]
+            cell = "-" if value is None else str(value)
+            if column in CHECKED and column in old and old[column] != value:
+                cell += f" ({old[column]})"
+            row += f"{cell:>19}"
+        print(row)
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the reasoning modes")
+    parser.add_argument("--engine", choices=["stub", "gguf"], default="stub")
+    parser.add_argument("--model", help="path to a GGUF model, implies --engine gguf")
+    parser.add_argument("--corpus", default=os.path.join(BENCHMARK_DIR, "puzzles.jsonl"))
+    parser.add_argument("--baseline", help="baseline JSON (default: benchmarks/baseline_<engine>.json)")
+    parser.add_argument("--write-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--modes", nargs="+", choices=list(MODES), default=list(MODES))
+    parser.add_argument("--tolerance", type=float, default=0.05)
+    parser.add_argument("--limit", type=int, help="only run the first N puzzles")
+    parser.add_argument("--verbose", action="store_true", help="show the search output")
+    parser.add_argument("--replicas", type=int, default=1, help="engine replicas in worker processes")
+    parser.add_argument("--stub-delay", type=float, default=0.0, help="simulated seconds per stub call")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)[:args.limit]
+    if args.model or args.engine == "gguf":
+        engine_kwargs = {"model_path": args.model} if args.model else {}
+        if args.replicas > 1:
+            engine = EnginePool(args.replicas, **engine_kwargs)
+        else:
+            from chat_engine import ChatEngine
+            engine = ChatEngine(**engine_kwargs)
+        engine_name = "gguf"
+    elif args.replicas > 1:
+        engine = EnginePool(args.replicas, engine_factory=functools.partial(StubEngine, corpus, delay=args.stub_delay))
+        engine_name = "stub"
+    else:
+        engine = StubEngine(corpus, delay=args.stub_delay)
+        engine_name = "stub"
+    if args.replicas > 1:
+        #parallel layers trade extra calls for latency, so they keep their own baseline
+        engine_name += f"_x{args.replicas}"
+    baseline_path = args.baseline or os.path.join(BENCHMARK_DIR, f"baseline_{engine_name}.json")
+    baseline = {}
+    if os.path.exists(baseline_path) and not args.write_baseline:
+        with open(baseline_path, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    #every question starts from the same chat, like a fresh GUI session
+    initial_history = list(engine.history)
+    results = {}
+    for mode_name in args.modes:
+        engine.history = list(initial_history)
+        results[mode_name] = run_mode(engine, mode_name, corpus, verbose=args.verbose)
+    print_table(results, baseline)
+    if isinstance(engine, EnginePool):
+        engine.close()
+
+    if args.write_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(baseline_path)), exist_ok=True)
+        with open(baseline_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"baseline written to {baseline_path}")
+        return 0
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,23 @@
+import threading
+
+#cooperative cancellation. a token is set from another thread (the GUI's abort button) and checked
+#by the searches between engine calls and by the engine between generated tokens
+
+class SearchCancelled(Exception):
+    pass
+
+class CancelToken:
+    #a token with a parent is also cancelled by it, so part of a search can be stopped on its own
+    def __init__(self, parent=None):
+        self.event = threading.Event()
+        self.parent = parent
+
+    def cancel(self):
+        self.event.set()
+
+    def cancelled(self):
+        return self.event.is_set() or (self.parent is not None and self.parent.cancelled())
+
+    def check(self):
+        if self.cancelled():
+            raise SearchCancelled()
@@ -0,0 +1,101 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from step_filter import shingles
+
+#persistent store of solved reasoning chains, so a repeated question does not pay for a new search.
+#questions are indexed by their normalized text (exact hits) and by their word n-gram shingles in an
+#inverted index (near hits: the same puzzle reworded, or with other names or numbers). a near hit is
+#only a candidate, the search verifies the stored solution against the new question before using it
+
+def normalize_question(text):
+    return " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+
+class ChainStore:
+    def __init__(self, path="../cache/chains.sqlite", threshold=0.6, ngram=3, max_grams=500):
+        self.path = path
+        #jaccard similarity of the shingles needed for a near hit
+        self.threshold = threshold
+        self.ngram = ngram
+        #longer questions only index their first grams, sqlite limits the parameters of one query
+        self.max_grams = max_grams
+        self.hits = {"exact": 0, "near": 0}
+        self.misses = 0
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS chains ("
+                        "key TEXT PRIMARY KEY, question TEXT NOT NULL, steps TEXT NOT NULL, grams INTEGER NOT NULL, "
+                        "created REAL NOT NULL, last_used REAL NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS grams ("
+                        "gram TEXT NOT NULL, key TEXT NOT NULL, PRIMARY KEY (gram, key)) WITHOUT ROWID")
+
+    def _key(self, normalized):
+        return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+    def _grams(self, normalized):
+        return sorted(" ".join(gram) for gram in shingles(normalized, self.ngram))[:self.max_grams]
+
+    def lookup(self, question):
+        #returns {"match": "exact" | "near", "question", "steps": [(step, score), ...], "similarity"} or None
+        normalized = normalize_question(question)
+        key = self._key(normalized)
+        grams = self._grams(normalized)
+        with self.lock:
+            row = self.db.execute("SELECT question, steps FROM chains WHERE key = ?", (key,)).fetchone()
+            match, similarity = "exact", 1.0
+            if row is None and grams:
+                #candidates share at least one gram, ranked by exact jaccard similarity
+                marks = ",".join("?" * len(grams))
+                best = None
+                for other, common, size in self.db.execute(
+                        f"SELECT g.key, COUNT(*), c.grams FROM grams g JOIN chains c ON c.key = g.key "
+                        f"WHERE g.gram IN ({marks}) GROUP BY g.key", grams):
+                    score = common / (len(grams) + size - common)
+                    if score >= self.threshold and (best is None or score > best[1]):
+                        best = (other, score)
+                if best is not None:
+                    key, similarity = best
+                    match = "near"
+                    row = self.db.execute("SELECT question, steps FROM chains WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits[match] += 1
+            self.db.execute("UPDATE chains SET last_used = ? WHERE key = ?", (time.time(), key))
+        return {"match": match, "question": row[0], "similarity": round(similarity, 3),
+                "steps": [tuple(step) for step in json.loads(row[1])]}
+
+    def put(self, question, steps):
+        #steps: [(step, score), ...] from the first step to the verified solution
+        normalized = normalize_question(question)
+        key = self._key(normalized)
+        grams = self._grams(normalized)
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.execute("DELETE FROM grams WHERE key = ?", (key,))
+                self.db.execute("INSERT OR REPLACE INTO chains VALUES (?, ?, ?, ?, ?, ?)",
+                                (key, question, json.dumps([list(step) for step in steps]), len(grams), now, now))
+                self.db.executemany("INSERT INTO grams VALUES (?, ?)", [(gram, key) for gram in grams])
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def stats(self):
+        with self.lock:
+            entries = self.db.execute("SELECT COUNT(*) FROM chains").fetchone()[0]
+        return {"exact_hits": self.hits["exact"], "near_hits": self.hits["near"], "misses": self.misses,
+                "entries": entries}
+
+    def close(self):
+        self.db.close()
@@ -1,28 +1,131 @@
 import os
-import sys
 import time
+import ctypes
+from collections import OrderedDict
 from email.policy import default
 from typing import List, Dict
-from llama_cpp import Llama
+import numpy as np
+import llama_cpp
+from llama_cpp import Llama, LlamaGrammar
+from completion_cache import CompletionCache
+from metrics import Tracer
+from cancellation import SearchCancelled
+from engine_registry import DEFAULT_MODEL
+
+class PrefixCache:
+    #LRU store of llama states, keyed by the exact token prefix they were evaluated on.
+    #bounded by a RAM budget rather than an entry count, since state size grows with the prefix
+    def __init__(self, capacity_bytes=2 << 30):
+        self.capacity_bytes = capacity_bytes
+        self.states = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, tokens):
+        return tuple(tokens) in self.states
+
+    def _state_bytes(self, state):
+        input_ids, data = state
+        return input_ids.nbytes + len(data)
+
+    def lookup(self, tokens):
+        #returns the state of the longest stored key that is a prefix of tokens
+        tokens = tuple(tokens)
+        best = None
+        for key in self.states:
+            if len(key) <= len(tokens) and (best is None or len(key) > len(best)):
+                if tokens[:len(key)] == key:
+                    best = key
+        if best is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.states.move_to_end(best)
+        return self.states[best]
+
+    def store(self, tokens, state):
+        key = tuple(tokens)
+        if key in self.states:
+            self.size -= self._state_bytes(self.states.pop(key))
+        self.states[key] = state
+        self.size += self._state_bytes(state)
+        #evict least recently used states until we are back under budget
+        while self.size > self.capacity_bytes and self.states:
+            _, old_state = self.states.popitem(last=False)
+            self.size -= self._state_bytes(old_state)
+
+    def discard(self, tokens):
+        state = self.states.pop(tuple(tokens), None)
+        if state is not None:
+            self.size -= self._state_bytes(state)
 
 class ChatEngine:
-    def __init__(self, model_path = "../models/Qwen2.5-7B-Instruct-Q4_K_M.gguf"):
+    def __init__(self, model_path = DEFAULT_MODEL, prefix_cache_bytes=2 << 30,
+                 completion_cache=None, cache_max_temperature=0.2, tracer=None, message_cache_size=4096,
+                 speculative=None, draft_model_path=None, draft_tokens=10,
+                 speculative_phases=("chat", "flash", "expand", "verify"), use_mmap=True, use_mlock=False,
+                 n_gpu_layers=-1, context_length=4096):
+        #seconds to load the model, and from the start of loading to the first generated token
+        self.startup = {"load_s": None, "first_token_s": None}
+        self.created = time.perf_counter()
         self.load_drivers()
-        self.context_length=4096
+        self.model_path=model_path
+        #tokens in the kv cache, shared by the sequences of a generate_batch
+        self.context_length=context_length
         self.answer_length=500
+        #opt-in persistent cache for repeatable calls. accepts a CompletionCache or a file path
+        if isinstance(completion_cache, str):
+            completion_cache = CompletionCache(completion_cache)
+        self.completion_cache = completion_cache
+        self.cache_max_temperature = cache_max_temperature
+        self.prefix_cache = PrefixCache(prefix_cache_bytes)
+        #tokens of recently formatted messages (LRU), so a prompt only tokenizes its new messages
+        self.message_tokens = OrderedDict()
+        self.message_cache_size = message_cache_size
+        self.bos_tokens = None
+        #token prefix of the last chat snapshot, see snapshot_history
+        self.session_prefix = None
+        self.digit_tokens = None
+        self.grammars = {}
+        #running totals of model work, used for search budgets
+        self.usage = {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        #opt-in per-call tracing (metrics.Tracer or a JSONL trace path)
+        if isinstance(tracer, str):
+            tracer = Tracer(tracer)
+        self.tracer = tracer
+        #opt-in speculative decoding: "prompt_lookup" (n-gram drafts from the prompt, no extra model)
+        #or "draft" (a small GGUF model at draft_model_path). only generations of speculative_phases
+        #use it, grader scores are a few tokens and gain nothing. drafts need logits for every prompt
+        #position, so llama keeps a n_ctx x n_vocab logits buffer (about 2.5GB of RAM for Qwen2.5 at
+        #4096 tokens) and prefix cache snapshots grow accordingly: worth it for long answers only
+        if draft_model_path and speculative is None:
+            speculative = "draft"
+        self.speculative_phases = set(speculative_phases)
+        self.draft = None
+        if speculative:
+            from speculative import make_draft_model
+            self.draft = make_draft_model(speculative, draft_model_path, num_pred_tokens=draft_tokens,
+                                          n_ctx=self.context_length)
+        #drafted and accepted tokens per phase
+        self.speculation = {}
         print(f"⏳ Initializing model (Context: {self.context_length} tokens)...")
         try:
             self.llm = Llama(
                 model_path=model_path,
-                n_gpu_layers=-1,  # force 100% load on GPU
+                n_gpu_layers=n_gpu_layers,  # -1 forces 100% load on GPU
                 n_ctx=self.context_length,  # maximum context memory capacity
+                draft_model=self.draft,  # speculative decoding, None when off
+                use_mmap=use_mmap,  # map the weights: fast load, shared page cache between processes
+                use_mlock=use_mlock,  # pin the weights in RAM so they are never paged out
                 verbose=False  # clean output
 
             )
-            print("model ready on GPU")
+            self.startup["load_s"] = round(time.perf_counter() - self.created, 3)
+            print(f"model ready on GPU ({self.startup['load_s']}s)")
         except Exception as e:
-            print(f"model loading failed: {e}")
-            sys.exit(1)
+            #raised, not exited: the engine may be loading on a background thread (engine_registry)
+            raise RuntimeError(f"model loading failed: {e}") from e
 
         #init history with a system prompt
         self.history= [
@@ -54,35 +157,451 @@ class ChatEngine:
         print("Warning: Could not find CUDA drivers.")
 
     def _manage_context(self):
-        while True:
-            #testing context length to check if answer can certainly fit in
-            full_prompt = ""
-            for msg in self.history:
-                full_prompt += f"<|im_start|>{msg['role']}\n{msg['content']}<|im_end|>\n"
-            tokens = self.llm.tokenize(full_prompt.encode('utf-8'))
-            count = len(tokens)
-            if count <= (self.context_length - self.answer_length):
-                return #enough space
-
-            else:
-                print(f"context full ({count}/{self.context_length}). "
-                      "deleting the first request and answer...")
-                #keep system prompt(history at index 0), delete first user request and ai response
+        #testing context length to check if answer can certainly fit in.
+        #counts come from the per-message token cache, evicting only subtracts them
+        counts = [len(self._text_tokens(self._format_messages([msg]))) for msg in self.history]
+        count = len(self._prompt_start()) + sum(counts)
+        while count > (self.context_length - self.answer_length) and len(self.history) > 2:
+            print(f"context full ({count}/{self.context_length}). "
+                  "deleting the first request and answer...")
+            #keep system prompt(history at index 0), delete first user request and ai response
+            for _ in range(min(2, len(self.history) - 2)):
                 self.history.pop(1)
-                self.history.pop(1)
-    def generate_answer(self,context,answer_length=None,**kwargs):
+                count -= counts.pop(1)
+    def _format_messages(self, messages, add_generation_prompt=False):
+        #ChatML, matching the Qwen chat template used by create_chat_completion
+        prompt = ""
+        for msg in messages:
+            prompt += f"<|im_start|>{msg['role']}\n{msg['content']}<|im_end|>\n"
+        if add_generation_prompt:
+            prompt += "<|im_start|>assistant\n"
+        return prompt
+
+    def _tokenize_messages(self, messages, add_generation_prompt=False):
+        #ChatML special tokens separate the messages, so tokenizing them one by one gives the same
+        #tokens as the whole prompt, and each message is only tokenized once while it is in use
+        tokens = list(self._prompt_start())
+        for msg in messages:
+            tokens += self._text_tokens(self._format_messages([msg]))
+        if add_generation_prompt:
+            tokens += self._text_tokens("<|im_start|>assistant\n")
+        return tokens
+
+    def count_tokens(self, messages):
+        #prompt length of messages, from the per-message token cache
+        return len(self._prompt_start()) + sum(len(self._text_tokens(self._format_messages([msg])))
+                                               for msg in messages)
+
+    def _prompt_start(self):
+        if self.bos_tokens is None:
+            self.bos_tokens = self.llm.tokenize(b"", add_bos=True, special=True)
+        return self.bos_tokens
+
+    def _text_tokens(self, text):
+        tokens = self.message_tokens.get(text)
+        if tokens is not None:
+            self.message_tokens.move_to_end(text)
+            return tokens
+        tokens = self.llm.tokenize(text.encode('utf-8'), add_bos=False, special=True)
+        self.message_tokens[text] = tokens
+        if len(self.message_tokens) > self.message_cache_size:
+            self.message_tokens.popitem(last=False)
+        return tokens
+
+    def _save_prefix_state(self):
+        #the llama state (kv cache plus the logits it holds, which count towards the cache budget)
+        #and the input ids. llama re-evaluates the last prompt token of every call, so the stored
+        #logits are never read back. string_at copies the buffer in one go, slicing the ctypes
+        #array would build a python list of every byte first
+        size = llama_cpp.llama_get_state_size(self.llm.ctx)
+        buffer = (ctypes.c_uint8 * int(size))()
+        n_bytes = llama_cpp.llama_copy_state_data(self.llm.ctx, buffer)
+        return self.llm.input_ids[:self.llm.n_tokens].copy(), ctypes.string_at(buffer, n_bytes)
+
+    def _load_prefix_state(self, state):
+        input_ids, data = state
+        buffer = (ctypes.c_uint8 * len(data)).from_buffer_copy(data)
+        if llama_cpp.llama_set_state_data(self.llm.ctx, buffer) != len(data):
+            raise RuntimeError("Failed to set llama state data")
+        self.llm.input_ids[:len(input_ids)] = input_ids
+        self.llm.n_tokens = len(input_ids)
+
+    def _restore_prefix(self, tokens):
+        #load the longest cached prefix of tokens, if it covers more than the kv cache already holds.
+        #returns how many tokens of the prompt are already evaluated
+        evaluated = Llama.longest_token_prefix(self.llm._input_ids.tolist(), tokens)
+        state = self.prefix_cache.lookup(tokens)
+        if state is not None and len(state[0]) > evaluated:
+            self._load_prefix_state(state)
+            evaluated = len(state[0])
+        return evaluated
+
+    def cache_prefix(self, messages):
+        #evaluate messages once and snapshot the kv cache, so that every later call
+        #whose context starts with these messages only pays for its own suffix
+        try:
+            tokens = self._tokenize_messages(messages)
+            if tokens in self.prefix_cache:
+                return
+            evaluated = self._restore_prefix(tokens)
+            self.llm.n_tokens = evaluated
+            if evaluated < len(tokens):
+                self.llm.eval(tokens[evaluated:])
+            self.prefix_cache.store(tokens, self._save_prefix_state())
+        except Exception as e:
+            print(f"\nError while caching prompt prefix: {e}")
+
+    def snapshot_history(self):
+        #snapshot the kv state of the whole chat after a turn, so the next turn only prefills its new
+        #user message, even when searches used the kv cache in between. the previous snapshot is a
+        #prefix of this one and is dropped, a session keeps a single state in the prefix cache
+        try:
+            tokens = tuple(self._tokenize_messages(self.history))
+        except Exception as e:
+            print(f"\nError while caching chat history: {e}")
+            return
+        if self.session_prefix is not None and self.session_prefix != tokens:
+            self.prefix_cache.discard(self.session_prefix)
+        self.cache_prefix(self.history)
+        self.session_prefix = tokens
+
+    def _digit_tokens(self):
+        if self.digit_tokens is None:
+            tokens = [self.llm.tokenize(str(d).encode('utf-8'), add_bos=False) for d in range(10)]
+            #scoring from logprobs only works if every digit is a single token
+            self.digit_tokens = [t[0] for t in tokens] if all(len(t) == 1 for t in tokens) else []
+        return self.digit_tokens
+
+    def _completion_key(self, kind, context, **params):
+        #only calls that are effectively repeatable are cached: seeded or low temperature,
+        #with a grammar given as GBNF text rather than a compiled object
+        if self.completion_cache is None:
+            return None
+        if params.get('grammar') is not None and not isinstance(params['grammar'], str):
+            return None
+        if params.get('seed') is None and params.get('temperature', 0.2) > self.cache_max_temperature:
+            return None
+        return self.completion_cache.make_key(self.model_path, context, dict(params, kind=kind))
+
+    def score_logprobs(self, context, answer_prefix="", min_mass=0.5, phase=None, depth=None, cancel=None):
+        #logprob scores are deterministic, so they can always be served from the completion cache
+        if cancel is not None:
+            cancel.check()
+        start = time.perf_counter()
+        key = self._completion_key("logprob", context, answer_prefix=answer_prefix, min_mass=min_mass, temperature=0)
+        if key is not None:
+            cached = self.completion_cache.get(key)
+            if cached is not None:
+                self._trace("logprob", phase, depth, start, cache_hit=True)
+                return cached["score"]
+        stats = {}
+        score = self._score_logprobs(context, answer_prefix, min_mass, stats)
+        if key is not None and score is not None:
+            self.completion_cache.put(key, {"score": score})
+        self._trace("logprob", phase, depth, start, **stats)
+        return score
+
+    def _trace(self, kind, phase, depth, start, **stats):
+        #report one engine call to the tracer, if tracing is on
+        if self.tracer is not None:
+            self.tracer.record(kind=kind, phase=phase, depth=depth,
+                               latency_s=round(time.perf_counter() - start, 6), **stats)
+
+    def _score_logprobs(self, context, answer_prefix, min_mass, stats):
+        #expected 0.0-1.0 score read from the next-token distribution after the grader prompt.
+        #one prefill plus two forced tokens ("0."), no sampling loop. returns None when the model
+        #does not want to answer with a number, so callers can fall back to generating text.
+        #answer_prefix is forced at the start of the answer, e.g. earlier lines of a score list
+        try:
+            digits = self._digit_tokens()
+            if not digits:
+                return None
+            prompt = self._format_messages(context, add_generation_prompt=True) + answer_prefix
+            tokens = self.llm.tokenize(prompt.encode('utf-8'), special=True)
+            evaluated = self._restore_prefix(tokens)
+            #the last prompt token is always re-evaluated so its logits are fresh
+            prefill_start = time.perf_counter()
+            self.llm.n_tokens = min(evaluated, len(tokens) - 1)
+            self.llm.eval(tokens[self.llm.n_tokens:])
+            self._record_usage(len(tokens), 0)
+            stats.update(prompt_tokens=len(tokens), cached_tokens=evaluated,
+                         ttft_s=round(time.perf_counter() - prefill_start, 6))
+            probs = np.exp(Llama.logits_to_logprobs(self.llm._scores[-1, :]))
+            p_zero, p_one = float(probs[digits[0]]), float(probs[digits[1]])
+            if p_zero + p_one < min_mass:
+                return None
+            #score = P(1) * 1.0 + P(0) * E[tenths digit | "0."]
+            self.llm.eval(self.llm.tokenize(b"0.", add_bos=False))
+            probs = np.exp(Llama.logits_to_logprobs(self.llm._scores[-1, :]))[digits]
+            tenths = float(np.dot(probs, np.arange(10)) / probs.sum()) / 10
+            return (p_one + p_zero * tenths) / (p_zero + p_one)
+        except Exception as e:
+            print(f"\nError during logprob scoring: {e}")
+            return None
+
+    def _decode(self, entries):
+        #entries are (seq_id, position, token, want_logits). llama batches can hold tokens
+        #of many kv sequences, so one decode call advances every sequence by a token.
+        #returns the logits row of each sequence that asked for one
+        batch = self.llm._batch
+        rows = {}
+        for start in range(0, len(entries), self.llm.n_batch):
+            chunk = entries[start:start + self.llm.n_batch]
+            batch.reset()
+            for i, (seq_id, position, token, want_logits) in enumerate(chunk):
+                batch.batch.token[i] = token
+                batch.batch.pos[i] = position
+                batch.batch.seq_id[i][0] = seq_id
+                batch.batch.n_seq_id[i] = 1
+                batch.batch.logits[i] = want_logits
+            batch.batch.n_tokens = len(chunk)
+            self.llm._ctx.decode(batch)
+            for i, (seq_id, _, _, want_logits) in enumerate(chunk):
+                if want_logits:
+                    logits = self.llm._ctx.get_logits_ith(i)
+                    rows[seq_id] = np.ctypeslib.as_array(logits, shape=(self.llm.n_vocab(),)).copy()
+        return rows
+
+    def _sample(self, logits, previous, rng, temperature=0.8, top_k=40, top_p=0.95, min_p=0.05, repeat_penalty=1.0):
+        #numpy port of llama's default sampler chain: penalties, top-k, top-p, min-p, temperature
+        logits = logits.astype(np.float64)
+        if repeat_penalty != 1.0 and previous:
+            recent = np.unique(previous[-self.llm.last_n_tokens_size:])
+            penalised = logits[recent]
+            logits[recent] = np.where(penalised > 0, penalised / repeat_penalty, penalised * repeat_penalty)
+        if temperature <= 0:
+            return int(np.argmax(logits))
+        if 0 < top_k < len(logits):
+            candidates = np.argpartition(-logits, top_k)[:top_k]
+        else:
+            candidates = np.arange(len(logits))
+        candidates = candidates[np.argsort(-logits[candidates])]
+        probs = np.exp(logits[candidates] - logits[candidates[0]])
+        probs /= probs.sum()
+        keep = max(1, int(np.searchsorted(np.cumsum(probs), top_p) + 1))
+        keep = min(keep, max(1, int(np.sum(probs >= min_p * probs[0]))))
+        candidates = candidates[:keep]
+        probs = np.exp((logits[candidates] - logits[candidates[0]]) / temperature)
+        return int(rng.choice(candidates, p=probs / probs.sum()))
+
+    def _batch_prompts(self, contexts):
+        #prompt tokens of each context, and how many of them it shares with the first context
+        prompts = [self._tokenize_messages(c, add_generation_prompt=True) for c in contexts]
+        shared = [min(Llama.longest_token_prefix(prompts[0], p), len(p) - 1) for p in prompts]
+        shared[0] = 0
+        return prompts, shared
+
+    def _batch_tokens(self, prompts, shared, answer_length):
+        #every sequence needs its unshared prompt and its answer inside the context window
+        return sum(len(p) - n for p, n in zip(prompts, shared)) + len(prompts) * answer_length
+
+    def batch_tokens(self, contexts, answer_length=None):
+        #context window a generate_batch of these contexts takes. above context_length it falls back
+        #to one generate_answer per context
+        if answer_length is None:
+            answer_length = self.answer_length
+        prompts, shared = self._batch_prompts(contexts)
+        return self._batch_tokens(prompts, shared, answer_length)
+
+    def generate_batch(self, contexts, answer_length=None, temperature=0.8, top_k=40, top_p=0.95,
+                       min_p=0.05, repeat_penalty=1.0, stop=None, seed=None, phase=None, depth=None, cancel=None):
+        #decode one continuation per context in parallel, each in its own kv sequence.
+        #sequences share the prompt prefix they have in common with the first context through
+        #kv copies, so N samples of one prompt cost a single prefill plus batched decode steps.
+        #outputs have the same shape as create_chat_completion results
         if answer_length is None:
             answer_length = self.answer_length
+        stop = [stop] if isinstance(stop, str) else (stop or [])
+        if cancel is not None:
+            cancel.check()
+        try:
+            prompts, shared = self._batch_prompts(contexts)
+            fits = self._batch_tokens(prompts, shared, answer_length) <= self.context_length
+        except Exception as e:
+            print(f"\nError during generation: {e}")
+            return [None] * len(contexts)
+        if not fits:
+            #outside the try, an abort (SearchCancelled) must reach the search
+            return [self.generate_answer(c, answer_length, temperature=temperature, top_k=top_k, top_p=top_p,
+                                         min_p=min_p, repeat_penalty=repeat_penalty, stop=stop, seed=seed,
+                                         phase=phase, depth=depth, cancel=cancel)
+                    for c in contexts]
+
+        rng = np.random.default_rng(seed)
+        start = time.perf_counter()
+        try:
+            #sequence 0 is llama's own sequence, so its prompt also benefits from the prefix cache
+            evaluated = self._restore_prefix(prompts[0])
+            self.llm.n_tokens = min(evaluated, len(prompts[0]) - 1)
+            self.llm.eval(prompts[0][self.llm.n_tokens:])
+            logits = {0: self.llm._scores[-1, :].copy()}
+            entries = []
+            for seq_id in range(1, len(prompts)):
+                self.llm._ctx.kv_cache_seq_cp(0, seq_id, 0, shared[seq_id])
+                suffix = prompts[seq_id][shared[seq_id]:]
+                entries += [(seq_id, shared[seq_id] + i, token, i == len(suffix) - 1) for i, token in enumerate(suffix)]
+            logits.update(self._decode(entries))
+            ttft = time.perf_counter() - start
+
+            answers = [[] for _ in prompts]
+            texts = [""] * len(prompts)
+            finish = ["length"] * len(prompts)
+            active = list(range(len(prompts)))
+            for step in range(answer_length):
+                if cancel is not None:
+                    cancel.check()
+                entries = []
+                for seq_id in list(active):
+                    token = self._sample(logits[seq_id], prompts[seq_id] + answers[seq_id], rng, temperature,
+                                         top_k, top_p, min_p, repeat_penalty)
+                    if llama_cpp.llama_token_is_eog(self.llm.model, token):
+                        finish[seq_id] = "stop"
+                        active.remove(seq_id)
+                        continue
+                    answers[seq_id].append(token)
+                    texts[seq_id] = self.llm.detokenize(answers[seq_id]).decode('utf-8', errors='ignore')
+                    hits = [texts[seq_id].index(s) for s in stop if s in texts[seq_id]]
+                    if hits:
+                        texts[seq_id] = texts[seq_id][:min(hits)]
+                        finish[seq_id] = "stop"
+                        active.remove(seq_id)
+                        continue
+                    entries.append((seq_id, len(prompts[seq_id]) + step, token, True))
+                if not active:
+                    break
+                logits = self._decode(entries)
+        except SearchCancelled:
+            raise
+        except Exception as e:
+            print(f"\nError during batched generation: {e}")
+            return [None] * len(contexts)
+        finally:
+            #drop the extra sequences and the sampled tokens, leaving the kv cache at prompt 0
+            for seq_id in range(1, len(prompts)):
+                self.llm._ctx.kv_cache_seq_rm(seq_id, 0, -1)
+            self.llm._ctx.kv_cache_seq_rm(0, len(prompts[0]), -1)
+            self.llm.n_tokens = min(self.llm.n_tokens, len(prompts[0]))
+
+        self._record_usage(sum(len(p) for p in prompts), sum(len(a) for a in answers), calls=len(prompts))
+        self._trace("batch", phase, depth, start, sequences=len(prompts), cached_tokens=evaluated,
+                    prompt_tokens=sum(len(p) for p in prompts), completion_tokens=sum(len(a) for a in answers),
+                    ttft_s=round(ttft, 6))
+        return [{"choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                              "finish_reason": reason}],
+                 "usage": {"prompt_tokens": len(prompt), "completion_tokens": len(answer),
+                           "total_tokens": len(prompt) + len(answer)}}
+                for prompt, answer, text, reason in zip(prompts, answers, texts, finish)]
+
+    def _grammar(self, grammar):
+        #GBNF grammars are compiled once and reused by every call of the same kind
+        if not isinstance(grammar, str):
+            return grammar
+        if grammar not in self.grammars:
+            self.grammars[grammar] = LlamaGrammar.from_string(grammar, verbose=False)
+        return self.grammars[grammar]
+
+    def generate_answer(self,context,answer_length=None,grammar=None,stop=None,phase=None,depth=None,
+                        cancel=None,on_token=None,**kwargs):
+        #phase and depth only label the call in the trace. on_token receives the text as it streams,
+        #cancel (a CancelToken) stops the generation between tokens by raising SearchCancelled
+        if cancel is not None:
+            cancel.check()
+        start = time.perf_counter()
+        if answer_length is None:
+            answer_length = self.answer_length
+        key = self._completion_key("chat", context, answer_length=answer_length, grammar=grammar, stop=stop, **kwargs)
+        if key is not None:
+            cached = self.completion_cache.get(key)
+            if cached is not None:
+                self._trace("chat", phase, depth, start, cache_hit=True)
+                if on_token is not None:
+                    on_token(cached['choices'][0]['message']['content'])
+                return cached
+        stats = {}
+        speculative = self.draft is not None and phase in self.speculative_phases
+        output = self._generate_answer(context, answer_length, grammar, stop, stats, cancel, on_token,
+                                       speculative, **kwargs)
+        if speculative:
+            totals = self.speculation.setdefault(phase, {"drafted": 0, "accepted": 0})
+            totals["drafted"] += stats.get("draft_tokens", 0)
+            totals["accepted"] += stats.get("accepted_tokens", 0)
+        if key is not None and output:
+            self.completion_cache.put(key, output)
+        self._trace("chat", phase, depth, start, **stats)
+        return output
+
+    def speculation_stats(self):
+        #acceptance rate of drafted tokens per phase, a low rate means speculation costs more than it saves
+        return {phase: dict(totals, acceptance_rate=round(totals["accepted"] / totals["drafted"], 3)
+                            if totals["drafted"] else None)
+                for phase, totals in self.speculation.items()}
+
+    def _record_usage(self, prompt_tokens, completion_tokens, calls=1):
+        #compute actually spent by the model, cache hits are not counted
+        self.usage["calls"] += calls
+        self.usage["prompt_tokens"] += prompt_tokens
+        self.usage["completion_tokens"] += completion_tokens
+
+    def _generate_answer(self,context,answer_length,grammar,stop,stats,cancel=None,on_token=None,speculative=False,
+                         **kwargs):
+        prompt_tokens = 0
+        try:
+            tokens = self._tokenize_messages(context, add_generation_prompt=True)
+            prompt_tokens = len(tokens)
+            stats["cached_tokens"] = self._restore_prefix(tokens)
+        except Exception as e:
+            print(f"\nError while restoring prompt prefix: {e}")
+        #always streamed: a cancelled call stops decoding at the next token, and the partial
+        #text reaches on_token while it is generated
+        start = time.perf_counter()
+        text = ""
+        finish_reason = None
+        chunks = None
+        #the draft model is switched per call, llama only drafts while it is set
+        self.llm.draft_model = self.draft if speculative else None
+        if speculative:
+            drafted, accepted = self.draft.drafted, self.draft.accepted
         try:
-            output = self.llm.create_chat_completion(
+            chunks = self.llm.create_chat_completion(
                 messages=context,
                 max_tokens=answer_length,  # Cap response length
+                grammar=self._grammar(grammar),  # constrain output format (GBNF)
+                stop=stop or [],
+                stream=True,
                 **kwargs
             )
-            return output
+            for chunk in chunks:
+                if cancel is not None:
+                    cancel.check()
+                choice = chunk['choices'][0]
+                piece = choice['delta'].get('content')
+                if piece:
+                    if not text:
+                        stats["ttft_s"] = round(time.perf_counter() - start, 6)
+                        if self.startup["first_token_s"] is None:
+                            self.startup["first_token_s"] = round(time.perf_counter() - self.created, 3)
+                    text += piece
+                    if on_token is not None:
+                        on_token(piece)
+                finish_reason = choice.get('finish_reason') or finish_reason
+            completion_tokens = len(self.llm.tokenize(text.encode('utf-8'), add_bos=False)) if text else 0
+        except SearchCancelled:
+            raise
         except Exception as e:
             print(f"\nError during generation: {e}")
             return None
+        finally:
+            if chunks is not None:
+                chunks.close()
+            if speculative:
+                self.draft.finish()
+                stats.update(draft_tokens=self.draft.drafted - drafted, accepted_tokens=self.draft.accepted - accepted)
+        self._record_usage(prompt_tokens, completion_tokens)
+        stats.update(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+        return {"choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                             "finish_reason": finish_reason}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                          "total_tokens": prompt_tokens + completion_tokens}}
     def chat_loop(self):
         print("\n💬 Chat Session Started (Type 'exit' to quit)")
         print("-" * 50)
@@ -102,7 +621,7 @@ class ChatEngine:
             print("Thinking...")
             #generate answer
             start = time.time()
-            output = self.generate_answer(self.history)
+            output = self.generate_answer(self.history, phase="chat")
             response_time = time.time() - start
             #print response with metrics
             if output:
@@ -110,10 +629,13 @@ class ChatEngine:
                 token_count = output['usage']['completion_tokens']
                 speed = token_count / response_time
                 print(f"({response_time:.1f} seconds, {speed:.1f} tokens/s)")
+                if self.draft is not None and "chat" in self.speculation:
+                    print(f"(speculative: {self.speculation_stats()['chat']['acceptance_rate']} of drafted tokens accepted)")
                 print(f"AI: {response_text}")
 
                 # add chat history to memory
                 self.history.append({"role": "assistant", "content": response_text})
+                self.snapshot_history()
 
 # --- Entry Point ---
 if __name__ == "__main__":
@@ -0,0 +1,77 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+class CompletionCache:
+    #persistent cache of deterministic engine results (low temperature or seeded calls).
+    #backed by sqlite in WAL mode, so several processes can share one cache file.
+    #entries are evicted least-recently-used once the stored results exceed max_bytes
+    def __init__(self, path="../cache/completions.sqlite", max_bytes=256 << 20):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.lock = threading.Lock()
+        #autocommit mode, write transactions are opened explicitly below
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS completions ("
+                        "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS completions_last_used ON completions (last_used)")
+
+    def make_key(self, model, messages, params):
+        #hash of everything that decides the result: model, messages and sampling params (incl. seed)
+        payload = json.dumps({"model": model,
+                              "messages": [dict(msg) for msg in messages],
+                              "params": params}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.db.execute("UPDATE completions SET last_used = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        data = json.dumps(value)
+        with self.lock:
+            #IMMEDIATE takes the write lock up front, so concurrent writers queue instead of failing
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.execute("INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)",
+                                (key, data, len(data), time.time()))
+                self._evict()
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def _evict(self):
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        expired = []
+        for key, size in self.db.execute("SELECT key, size FROM completions ORDER BY last_used"):
+            if total <= self.max_bytes:
+                break
+            expired.append((key,))
+            total -= size
+        self.db.executemany("DELETE FROM completions WHERE key = ?", expired)
+
+    def stats(self):
+        with self.lock:
+            entries, size = self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": size}
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,42 @@
+#fits search contexts into the model's context window.
+#the system prompt, the problem and the most recent steps are kept; old chat turns go first,
+#then the oldest steps of the path. steps are dropped in fixed chunks, so the context of a path
+#(and its cached kv prefix) only changes every few layers instead of at every new step.
+#siblings are expanded and graded from the same context, so they keep sharing one prefix
+
+class ContextBuilder:
+    def __init__(self, engine, chunk=4):
+        self.engine = engine
+        self.chunk = chunk
+        #how many contexts had to be shortened
+        self.trimmed = 0
+
+    def count(self, messages):
+        return self.engine.count_tokens(messages)
+
+    def omitted(self, count):
+        return {"role": "assistant", "content": f"... ({count} earlier steps omitted)"}
+
+    def build(self, history, path, reserve=0):
+        #history: chat so far (system prompt first), path: [problem, step, step, ...]
+        #reserve: tokens left free for the prompt and the answer
+        budget = self.engine.context_length - reserve
+        history, path = list(history), list(path)
+        if self.count(history + path) <= budget:
+            return history + path
+        self.trimmed += 1
+        #old chat turns, a request and its answer at a time. the system prompt stays
+        while len(history) > 1 and self.count(history + path) > budget:
+            del history[1:3]
+        context = history + path
+        if self.count(context) <= budget:
+            return context
+        #middle steps, oldest first. the problem and the last step stay
+        problem, steps = path[0], path[1:]
+        dropped = 0
+        while dropped < len(steps) - 1:
+            dropped = min(dropped + self.chunk, len(steps) - 1)
+            context = history + [problem, self.omitted(dropped)] + steps[dropped:]
+            if self.count(context) <= budget:
+                break
+        return context
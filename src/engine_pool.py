@@ -0,0 +1,133 @@
+import multiprocessing
+import threading
+import itertools
+
+#N engine replicas in worker processes, behind the single-engine interface the searches use.
+#llama maps the GGUF file (use_mmap), so the replicas share one copy of the weights in the page
+#cache and only pay for their own kv cache. a search with layer_workers > 1 expands the nodes of
+#a beam layer on parallel threads; each thread is pinned to one replica, so the kv prefix a
+#replica caches for a node is reused by that node's grading calls.
+#  pool = EnginePool(4, model_path="../models/model.gguf")
+#  pool = EnginePool(4, engine_factory=functools.partial(StubEngine, corpus))   (no model needed)
+#  BeamSearch(engine=pool, layer_workers=4)
+
+def _plain(messages):
+    #contexts may hold read-only MappingProxyType messages, which do not pickle
+    return [dict(msg) for msg in messages]
+
+def _worker(conn, engine_factory, engine_kwargs):
+    if engine_factory is None:
+        from chat_engine import ChatEngine
+        engine_factory = ChatEngine
+    engine = engine_factory(**engine_kwargs)
+    conn.send({"history": _plain(engine.history), "context_length": engine.context_length,
+               "answer_length": engine.answer_length, "model_path": getattr(engine, "model_path", None)})
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        method, args, kwargs = request
+        before = dict(engine.usage)
+        try:
+            result, ok = getattr(engine, method)(*args, **kwargs), True
+        except Exception as e:
+            result, ok = e, False
+        usage = {key: engine.usage[key] - before[key] for key in before}
+        conn.send((ok, result, usage))
+    conn.close()
+
+
+class Replica:
+    def __init__(self, context, engine_factory, engine_kwargs):
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=_worker, args=(child, engine_factory, engine_kwargs), daemon=True)
+        self.process.start()
+        child.close()
+        #one request at a time per replica
+        self.lock = threading.Lock()
+        self.info = None
+
+    def ready(self):
+        if self.info is None:
+            self.info = self.conn.recv()
+        return self.info
+
+    def call(self, method, args, kwargs):
+        with self.lock:
+            self.conn.send((method, args, kwargs))
+            return self.conn.recv()
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+class EnginePool:
+    def __init__(self, replicas=2, engine_factory=None, **engine_kwargs):
+        #engine_factory must be picklable (a class or functools.partial); default is ChatEngine
+        context = multiprocessing.get_context("spawn")
+        self.replicas = [Replica(context, engine_factory, engine_kwargs) for _ in range(replicas)]
+        info = [replica.ready() for replica in self.replicas][0]
+        self.history = info["history"]
+        self.context_length = info["context_length"]
+        self.answer_length = info["answer_length"]
+        self.model_path = info["model_path"]
+        self.tracer = None
+        self.usage = {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        self.usage_lock = threading.Lock()
+        #each calling thread is pinned to a replica, assigned round robin on its first call
+        self.local = threading.local()
+        self.next_replica = itertools.count()
+
+    def __len__(self):
+        return len(self.replicas)
+
+    def _replica(self):
+        replica = getattr(self.local, "replica", None)
+        if replica is None:
+            replica = self.replicas[next(self.next_replica) % len(self.replicas)]
+            self.local.replica = replica
+        return replica
+
+    def _call(self, method, *args, **kwargs):
+        #callbacks and cancel tokens stay in this process: cancellation is checked before sending
+        cancel = kwargs.pop("cancel", None)
+        on_token = kwargs.pop("on_token", None)
+        if cancel is not None:
+            cancel.check()
+        ok, result, usage = self._replica().call(method, args, kwargs)
+        with self.usage_lock:
+            for key in self.usage:
+                self.usage[key] += usage[key]
+        if not ok:
+            raise result
+        if on_token is not None and method == "generate_answer" and result:
+            on_token(result['choices'][0]['message']['content'])
+        return result
+
+    def generate_answer(self, context, *args, **kwargs):
+        return self._call("generate_answer", _plain(context), *args, **kwargs)
+
+    def generate_batch(self, contexts, *args, **kwargs):
+        return self._call("generate_batch", [_plain(context) for context in contexts], *args, **kwargs)
+
+    def score_logprobs(self, context, *args, **kwargs):
+        return self._call("score_logprobs", _plain(context), *args, **kwargs)
+
+    def cache_prefix(self, messages):
+        return self._call("cache_prefix", _plain(messages))
+
+    def count_tokens(self, messages):
+        return self._call("count_tokens", _plain(messages))
+
+    def batch_tokens(self, contexts, *args):
+        return self._call("batch_tokens", [_plain(context) for context in contexts], *args)
+
+    def close(self):
+        for replica in self.replicas:
+            replica.close()
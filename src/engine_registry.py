@@ -0,0 +1,83 @@
+import argparse
+import os
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+#process wide registry of loaded ChatEngines, keyed by model path and load params, so every caller
+#asking for the same model shares one instance instead of loading another copy of the weights.
+#loads run in a background thread (warm_load), callers that need the engine wait for it (get_engine).
+#chat_engine (and with it llama_cpp and numpy) is only imported when an engine is actually loaded,
+#so tools that only use the search or tree code start fast.
+#  python engine_registry.py --model ../models/model.gguf      (measure import, load and first token times)
+
+DEFAULT_MODEL = "../models/Qwen2.5-7B-Instruct-Q4_K_M.gguf"
+
+_engines = {}
+_lock = threading.Lock()
+
+def engine_key(model_path, params):
+    return os.path.abspath(model_path), tuple(sorted((name, repr(value)) for name, value in params.items()))
+
+def warm_load(model_path=DEFAULT_MODEL, **params):
+    #returns a Future of the engine, starting the load in the background unless it is loaded or loading.
+    #params go to ChatEngine (use_mmap, use_mlock, n_gpu_layers, tracer, ...)
+    key = engine_key(model_path, params)
+    with _lock:
+        future = _engines.get(key)
+        if future is not None:
+            return future
+        future = Future()
+        _engines[key] = future
+    threading.Thread(target=_load, args=(key, future, model_path, params), name="engine-load", daemon=True).start()
+    return future
+
+def _load(key, future, model_path, params):
+    try:
+        from chat_engine import ChatEngine
+        future.set_result(ChatEngine(model_path=model_path, **params))
+    except Exception as e:
+        #a failed load is forgotten, the next request tries again
+        with _lock:
+            _engines.pop(key, None)
+        future.set_exception(e)
+
+def get_engine(model_path=DEFAULT_MODEL, **params):
+    #the shared engine for these settings, waits for a load in progress
+    return warm_load(model_path, **params).result()
+
+def loaded_engines():
+    with _lock:
+        futures = list(_engines.values())
+    return [future.result() for future in futures if future.done() and not future.exception()]
+
+def measure_startup(model_path=DEFAULT_MODEL, **params):
+    #cold start costs: importing llama_cpp, loading the model, the first answer token and a warm one
+    timings = {}
+    start = time.perf_counter()
+    import chat_engine
+    timings["import_s"] = round(time.perf_counter() - start, 3)
+    engine = get_engine(model_path, **params)
+    timings["load_s"] = engine.startup["load_s"]
+    question = [{"role": "user", "content": "Say hi."}]
+    for name in ("first_ttft_s", "warm_ttft_s"):
+        stats = {}
+        engine._generate_answer(engine.history + question, 8, None, None, stats)
+        timings[name] = stats.get("ttft_s")
+    timings["to_first_token_s"] = engine.startup["first_token_s"]
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure engine startup and time to first token")
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--no-mmap", action="store_true", help="read the weights into RAM instead of mapping them")
+    parser.add_argument("--mlock", action="store_true", help="lock the weights in RAM")
+    args = parser.parse_args()
+    timings = measure_startup(args.model, use_mmap=not args.no_mmap, use_mlock=args.mlock)
+    for name, value in timings.items():
+        print(f"{name:<18}{value}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
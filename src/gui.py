@@ -10,18 +10,16 @@ from tkinter import ttk
 import threading
 import queue
 import time
-from chat_engine import ChatEngine
-from search import BeamSearch
+from engine_registry import warm_load
+from modes import MODES, make_searcher
+from cancellation import CancelToken, SearchCancelled
 
 # --- CONFIGURATION ---
 ctk.set_appearance_mode("Dark")
 ctk.set_default_color_theme("blue")
-
-MODES = {
-    "⚡ Flash": {"width": 1, "depth": 1, "retries": 0, "type": "direct"},
-    "🤔 Thinking": {"width": 3, "depth": 7, "retries": 0, "type": "search"},
-    "🧠 Ultra": {"width": 4, "depth": 10, "retries": 2, "type": "search"}
-}
+# Tree items start expanded until this many are drawn. Beyond it, branches are only drawn when
+# they are opened, so trees with thousands of nodes stay responsive.
+LAZY_TREE_AFTER = 500
 
 
 class ModernReasoningApp(ctk.CTk):
@@ -32,17 +30,40 @@ class ModernReasoningApp(ctk.CTk):
 
         self.msg_queue = queue.Queue()
         self.engine = None
+        # The model loads in the background while the window opens; the first query waits for it.
+        self.engine_future = warm_load()
+        self.engine_future.add_done_callback(self._on_engine_loaded)
         self.current_searcher = None
         self.is_running = False
         self.start_time = 0
+        self.cancel_token = None
+        # Streaming output: the Flash answer bubble being filled, and a ticker of the step being generated.
+        self.stream_box = None
+        self.stream_text = ""
+        self.live_step = ""
+        # Incremental tree: node <-> Treeview item maps, items whose children are drawn,
+        # and coalesced node updates waiting for the next redraw.
+        self.node_items = {}
+        self.item_nodes = {}
+        self.expanded_items = set()
+        self.pending_updates = {}
 
         self.grid_columnconfigure(1, weight=1)
         self.grid_rowconfigure(0, weight=1)
 
         self._setup_ui()
         self._setup_tree_style()
+        if not self.engine_future.done():
+            self.status_label.configure(text="Loading model...")
         self.after(100, self._process_queue)
 
+    def _on_engine_loaded(self, future):
+        """Reports the background model load (runs on the loader thread)."""
+        if future.exception():
+            self.msg_queue.put(("status", f"Model failed to load: {future.exception()}"))
+        else:
+            self.msg_queue.put(("status", f"Ready (model loaded in {future.result().startup['load_s']}s)"))
+
     def _setup_tree_style(self):
         """Configures ttk.Treeview to match CustomTkinter dark theme."""
         style = ttk.Style()
@@ -110,6 +131,7 @@ class ModernReasoningApp(ctk.CTk):
         self.tree.column("score", width=80, anchor="center")
         self.tree.column("type", width=100, anchor="center")
         self.tree.bind("<<TreeviewSelect>>", self.on_tree_select)
+        self.tree.bind("<<TreeviewOpen>>", self.on_tree_open)
 
         scrollbar = ttk.Scrollbar(tree_frame, orient="vertical", command=self.tree.yview)
         self.tree.configure(yscroll=scrollbar.set)
@@ -133,11 +155,17 @@ class ModernReasoningApp(ctk.CTk):
         selected_items = self.tree.selection()
         if not selected_items: return
         item_id = selected_items[0]
-        if hasattr(self, 'node_map') and item_id in self.node_map:
-            text = self.node_map[item_id]
+        if item_id in self.item_nodes:
+            text = self.item_nodes[item_id].content
             self.detail_box.delete("0.0", "end")
             self.detail_box.insert("0.0", text)
 
+    def on_tree_open(self, event):
+        """Draws the children of a lazily rendered branch when it is opened."""
+        item_id = self.tree.focus()
+        if item_id in self.item_nodes:
+            self._expand_item(item_id)
+
     def add_chat_bubble(self, role, text):
         """Adds a message to the chat history scrollable frame."""
         bubble_frame = ctk.CTkFrame(self.chat_scroll, fg_color="transparent")
@@ -159,91 +187,145 @@ class ModernReasoningApp(ctk.CTk):
 
         box.insert("0.0", text)
         box.configure(state="disabled")
+        self._fit_box(box, text)
+        return box
 
+    def _fit_box(self, box, text):
+        """Resizes a chat bubble to its text."""
         line_count = text.count('\n') + 1
         char_count = len(text)
         approx_lines = line_count + (char_count // 90)
         new_height = min(600, max(50, approx_lines * 22 + 20))
         box.configure(height=new_height)
 
+    def _set_stream_text(self, text):
+        """Replaces the text of the streaming answer bubble."""
+        self.stream_box.configure(state="normal")
+        self.stream_box.delete("0.0", "end")
+        self.stream_box.insert("0.0", text)
+        self.stream_box.configure(state="disabled")
+        self._fit_box(self.stream_box, text)
+
     def _process_queue(self):
         """Polls the background thread queue and updates UI components."""
         if self.is_running:
             elapsed = time.time() - self.start_time
-            self.status_label.configure(text=f"Thinking... ({elapsed:.1f}s)")
-
-            # Polling the active searcher for tree visualization
-            if self.current_searcher and self.current_searcher.root:
-                self.populate_tree(self.current_searcher.root)
+            if self.cancel_token and self.cancel_token.cancelled():
+                self.status_label.configure(text="Stopping...")
+            elif self.live_step:
+                self.status_label.configure(text=f"Thinking... ({elapsed:.1f}s)\n{self.live_step[-40:]}")
+            else:
+                self.status_label.configure(text=f"Thinking... ({elapsed:.1f}s)")
 
         try:
             while True:
                 msg_type, data = self.msg_queue.get_nowait()
                 if msg_type == "status":
-                    pass
+                    if not self.is_running:
+                        self.status_label.configure(text=data)
+                elif msg_type == "tree_event":
+                    self._apply_tree_event(*data)
+                elif msg_type == "partial":
+                    if self.stream_box is None:
+                        self.stream_box = self.add_chat_bubble("AI", "")
+                        self.tab_view.set("💬 Chat History")
+                    self.stream_text += data
+                    self._set_stream_text(self.stream_text)
+                elif msg_type == "live_step":
+                    self.live_step = (self.live_step + data)[-200:].replace('\n', ' ')
                 elif msg_type == "final_result":
-                    self.add_chat_bubble("AI", data)
+                    if self.stream_box is not None:
+                        self._set_stream_text(data)
+                    else:
+                        self.add_chat_bubble("AI", data)
                     self.tab_view.set("💬 Chat History")
                 elif msg_type == "error":
                     self.add_chat_bubble("System", f"ERROR: {data}")
+                elif msg_type == "cancelled":
+                    self.add_chat_bubble("System", "Stopped.")
                 elif msg_type == "done":
                     self.is_running = False
                     self.current_searcher = None
+                    self.cancel_token = None
+                    self.stream_box = None
+                    self.stream_text = ""
+                    self.live_step = ""
                     self.action_btn.configure(text="Start Reasoning", fg_color=["#3B8ED0", "#1F6AA5"])
                     self.status_label.configure(text="Ready")
         except queue.Empty:
             pass
         finally:
-            self.after(500, self._process_queue)
+            # Score updates are coalesced: each changed node is redrawn once per tick.
+            self._flush_tree_updates()
+            self.after(50, self._process_queue)
 
     def toggle_search(self):
         """Handles Start/Abort logic."""
         if self.is_running:
-            self.is_running = False
-            self.status_label.configure(text="Stopping...")
-            self.action_btn.configure(text="Start Reasoning")
+            # The worker stops at its next token or engine call and then reports "done".
+            if self.cancel_token and not self.cancel_token.cancelled():
+                self.cancel_token.cancel()
+                self.status_label.configure(text="Stopping...")
+                self.action_btn.configure(text="Stopping...")
             return
 
         question = self.input_box.get()
         if not question: return
 
         self.is_running = True
+        self.cancel_token = CancelToken()
         self.start_time = time.time()
         self.action_btn.configure(text="ABORT", fg_color="#ff4d4f", hover_color="#d9363e")
         self.tree.delete(*self.tree.get_children())
+        self.node_items = {}
+        self.item_nodes = {}
+        self.expanded_items = set()
+        self.pending_updates = {}
         self.detail_box.delete("0.0", "end")
         self.tab_view.set("🌳 Live Logic Tree")
-        self.node_map = {}
         self.add_chat_bubble("User", question)
 
         mode = self.mode_var.get()
-        threading.Thread(target=self.run_logic, args=(question, mode), daemon=True).start()
+        threading.Thread(target=self.run_logic, args=(question, mode, self.cancel_token), daemon=True).start()
 
-    def run_logic(self, question, mode_name):
+    def run_logic(self, question, mode_name, cancel_token):
         try:
             if not self.engine:
-                self.msg_queue.put(("status", "Loading Engine..."))
-                self.engine = ChatEngine()
+                # Usually loaded by now; otherwise wait for the warm load started at launch.
+                if self.engine_future.done() and self.engine_future.exception():
+                    # The last load failed, try again.
+                    self.engine_future = warm_load()
+                self.engine = self.engine_future.result()
 
             config = MODES[mode_name]
 
             # --- FLASH MODE ---
             if config["type"] == "direct":
                 self.engine.history.append({"role": "user", "content": question})
-                response = self.engine.generate_answer(self.engine.history, temperature=0.7)
+                try:
+                    response = self.engine.generate_answer(
+                        self.engine.history, temperature=0.7, phase="flash", cancel=cancel_token,
+                        on_token=lambda piece: self.msg_queue.put(("partial", piece)))
+                except SearchCancelled:
+                    # Keep the history alternating user/assistant.
+                    self.engine.history.pop()
+                    raise
                 if response:
                     txt = response['choices'][0]['message']['content']
                     self.engine.history.append({"role": "assistant", "content": txt})
+                    self.engine.snapshot_history()
                     self.msg_queue.put(("final_result", txt))
                 self.msg_queue.put(("done", True))
                 return
 
             # --- SEARCH MODE ---
-            searcher = BeamSearch(
-                engine=self.engine,
-                max_breadth=config["width"],
-                max_depth=config["depth"],
-                max_retries=config["retries"]
+            # The same presets as the benchmark and the server (MCTS is budgeted by LLM calls).
+            searcher = make_searcher(
+                config,
+                self.engine,
+                cancel_token=cancel_token,
+                on_token=lambda piece: self.msg_queue.put(("live_step", piece)),
+                on_event=self._on_search_event
             )
 
             self.current_searcher = searcher
@@ -254,6 +336,7 @@ class ModernReasoningApp(ctk.CTk):
                 # result_history includes [UserQ, Step1, Step2, ..., Solution]
                 # This ensures future Flash queries have context of the logic path.
                 self.engine.history.extend(result_history)
+                self.engine.snapshot_history()
 
                 formatted_chain = ""
                 step_count = 1
@@ -272,39 +355,115 @@ class ModernReasoningApp(ctk.CTk):
             else:
                 self.msg_queue.put(("error", "No solution found after all attempts."))
 
+        except SearchCancelled:
+            self.msg_queue.put(("cancelled", None))
         except Exception as e:
             self.msg_queue.put(("error", str(e)))
         finally:
             self.msg_queue.put(("done", True))
 
-    def populate_tree(self, root_node):
-        """Visualizes the current state of the BeamSearch tree."""
-        if not root_node: return
-
-        # Note: Full redraw is used for simplicity.
-        # In production with massive trees, delta updates would be preferred.
-        self.tree.delete(*self.tree.get_children())
-        queue = [(root_node, "")]
-        while queue:
-            node, parent_id = queue.pop(0)
-            node_id = str(id(node))
-            self.node_map[node_id] = node.content
-
-            content_lower = node.content.lower()
-            tag = "idea";
-            tag_text = "Step"
-            if node.depth == 0:
-                tag = "root"; tag_text = "Problem"
-            elif "solution:" in content_lower or "solved" in content_lower:
-                tag = "solution"; tag_text = "Solution"
-            elif "refute:" in content_lower:
-                tag = "refute"; tag_text = "Critique"
-
-            preview = node.content.replace('\n', ' ')[:80] + "..."
-            score = f"{getattr(node, 'value', 0.0):.2f}"
-            self.tree.insert(parent_id, "end", iid=node_id, text=preview, values=(score, tag_text), tags=(tag,),
-                             open=True)
-            for child in node.children: queue.append((child, node_id))
+    def _on_search_event(self, event, payload):
+        """Runs on the search thread: forwards tree changes to the UI thread."""
+        self.msg_queue.put(("tree_event", (event, payload)))
+
+    def _apply_tree_event(self, event, payload):
+        """Applies one search event to the tree view."""
+        if event == "node_added":
+            self._add_tree_node(payload["node"])
+        elif event == "score_updated":
+            node = payload["node"]
+            self.pending_updates[id(node)] = node
+        elif event == "beam_selected":
+            for node in payload["nodes"]:
+                self._reveal_node(node)
+
+    def _node_row(self, node):
+        """Text, column values and tag of a node's tree item."""
+        content_lower = node.content.lower()
+        tag = "idea";
+        tag_text = "Step"
+        if node.depth == 0:
+            tag = "root"; tag_text = "Problem"
+        elif "solution:" in content_lower or "solved" in content_lower:
+            tag = "solution"; tag_text = "Solution"
+        elif "refute:" in content_lower:
+            tag = "refute"; tag_text = "Critique"
+
+        preview = node.content.replace('\n', ' ')[:80] + "..."
+        score = f"{getattr(node, 'value', 0.0):.2f}"
+        return preview, (score, tag_text), (tag,)
+
+    def _insert_node(self, node, parent_id):
+        """Inserts a node, and the subtree below it if the item is drawn expanded."""
+        node_id = str(id(node))
+        if self.tree.exists(node_id):
+            return
+        preview, values, tags = self._node_row(node)
+        expanded = len(self.node_items) < LAZY_TREE_AFTER
+        self.tree.insert(parent_id, "end", iid=node_id, text=preview, values=values, tags=tags, open=expanded)
+        self.node_items[id(node)] = node_id
+        self.item_nodes[node_id] = node
+        # Merged states have several parents, draw them once under the first one.
+        children = [child for child in node.children if child.parent is node]
+        if expanded:
+            self.expanded_items.add(node_id)
+            for child in children:
+                self._insert_node(child, node_id)
+        elif children:
+            self._add_placeholder(node_id)
+
+    def _add_placeholder(self, node_id):
+        """Marks a collapsed item as having children, so it shows an expand arrow."""
+        placeholder = node_id + ":more"
+        if not self.tree.exists(placeholder):
+            self.tree.insert(node_id, "end", iid=placeholder, text="...", values=("", ""))
+
+    def _expand_item(self, node_id):
+        """Draws the children of a collapsed item."""
+        if node_id in self.expanded_items:
+            return
+        self.expanded_items.add(node_id)
+        if self.tree.exists(node_id + ":more"):
+            self.tree.delete(node_id + ":more")
+        node = self.item_nodes[node_id]
+        for child in node.children:
+            if child.parent is node:
+                self._insert_node(child, node_id)
+
+    def _add_tree_node(self, node):
+        """Draws a new node if its parent's children are drawn."""
+        if node.parent is None:
+            self._insert_node(node, "")
+            return
+        parent_id = self.node_items.get(id(node.parent))
+        if parent_id is None:
+            return  # Drawn when an ancestor is opened.
+        if parent_id in self.expanded_items:
+            self._insert_node(node, parent_id)
+        else:
+            self._add_placeholder(parent_id)
+
+    def _reveal_node(self, node):
+        """Opens the path down to a beam node, so the search frontier stays visible."""
+        path = []
+        while node.parent is not None:
+            node = node.parent
+            path.append(node)
+        for ancestor in reversed(path):
+            node_id = self.node_items.get(id(ancestor))
+            if node_id is None:
+                return
+            self._expand_item(node_id)
+            self.tree.item(node_id, open=True)
+
+    def _flush_tree_updates(self):
+        """Redraws the nodes whose score or text changed since the last tick."""
+        for node in self.pending_updates.values():
+            node_id = self.node_items.get(id(node))
+            if node_id is not None:
+                preview, values, tags = self._node_row(node)
+                self.tree.item(node_id, text=preview, values=values, tags=tags)
+        self.pending_updates = {}
 
 
 if __name__ == "__main__":
@@ -0,0 +1,153 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+#per-call tracing of engine work. the engine reports every call (phase, node depth, tokens,
+#time to first token, latency, cache hits) to a Tracer, which appends it to a JSONL trace and
+#aggregates it into metric registries. a search can collect its own registry for a summary.
+
+class Histogram:
+    #log-spaced buckets, enough for percentiles of latencies and token counts without keeping samples
+    def __init__(self, start=0.001, factor=2, buckets=32):
+        self.bounds = [start * factor ** i for i in range(buckets)]
+        self.counts = [0] * (buckets + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.bounds) and value > self.bounds[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def percentile(self, q):
+        #upper bound of the bucket holding the q-th value, clamped to the observed range
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                bound = self.bounds[index] if index < len(self.bounds) else self.max
+                return max(self.min, min(bound, self.max))
+        return self.max
+
+    def to_dict(self):
+        return {"count": self.count, "sum": round(self.sum, 6), "mean": round(self.mean(), 6),
+                "min": self.min, "max": self.max,
+                "p50": self.percentile(0.5), "p95": self.percentile(0.95), "p99": self.percentile(0.99)}
+
+
+class MetricsRegistry:
+    #counters and histograms keyed by (name, phase)
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, value=1, phase=None):
+        with self.lock:
+            self.counters[(name, phase)] = self.counters.get((name, phase), 0) + value
+
+    def observe(self, name, value, phase=None):
+        if value is None:
+            return
+        with self.lock:
+            histogram = self.histograms.get((name, phase))
+            if histogram is None:
+                #seconds get millisecond resolution, counts start at one token
+                histogram = Histogram(start=0.001 if name.endswith("_s") else 1)
+                self.histograms[(name, phase)] = histogram
+            histogram.observe(value)
+
+    def record(self, call):
+        phase = call.get("phase")
+        self.inc("calls", call.get("sequences", 1), phase)
+        if call.get("cache_hit"):
+            self.inc("cache_hits", 1, phase)
+        self.inc("cached_tokens", call.get("cached_tokens") or 0, phase)
+        #speculative decoding: drafted tokens and how many of them the model kept
+        self.inc("draft_tokens", call.get("draft_tokens") or 0, phase)
+        self.inc("accepted_tokens", call.get("accepted_tokens") or 0, phase)
+        for name in ("prompt_tokens", "completion_tokens", "ttft_s", "latency_s"):
+            self.observe(name, call.get(name), phase)
+
+    def phases(self):
+        return sorted({phase for _, phase in self.counters}, key=lambda phase: phase or "")
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "counters": {f"{name}{{phase={phase}}}": value for (name, phase), value in self.counters.items()},
+                "histograms": {f"{name}{{phase={phase}}}": histogram.to_dict()
+                               for (name, phase), histogram in self.histograms.items()},
+            }
+
+    def summary(self):
+        #one line per phase: calls, cache hits, tokens, draft acceptance and latency percentiles
+        lines = [f"{'phase':<10}{'calls':>7}{'hits':>6}{'prompt':>9}{'cached':>9}{'output':>8}{'accept':>8}"
+                 f"{'ttft p50':>10}{'lat p50':>9}{'lat p95':>9}{'total s':>9}"]
+        for phase in self.phases():
+            histogram = lambda name: self.histograms.get((name, phase), Histogram())
+            drafted = self.counters.get(('draft_tokens', phase), 0)
+            accept = f"{self.counters.get(('accepted_tokens', phase), 0) / drafted:.0%}" if drafted else "-"
+
+            lines.append(f"{phase or '-':<10}"
+                         f"{self.counters.get(('calls', phase), 0):>7}"
+                         f"{self.counters.get(('cache_hits', phase), 0):>6}"
+                         f"{histogram('prompt_tokens').sum:>9.0f}"
+                         f"{self.counters.get(('cached_tokens', phase), 0):>9}"
+                         f"{histogram('completion_tokens').sum:>8.0f}"
+                         f"{accept:>8}"
+                         f"{histogram('ttft_s').percentile(0.5):>10.3f}"
+                         f"{histogram('latency_s').percentile(0.5):>9.3f}"
+                         f"{histogram('latency_s').percentile(0.95):>9.3f}"
+                         f"{histogram('latency_s').sum:>9.2f}")
+        return "\n".join(lines)
+
+
+class Tracer:
+    #sink for engine calls: a JSONL trace file (optional) plus the registries currently collecting
+    def __init__(self, path=None):
+        self.registry = MetricsRegistry()
+        self.collectors = [self.registry]
+        self.lock = threading.Lock()
+        self.file = open(path, "a", encoding="utf-8") if path else None
+
+    def record(self, **call):
+        call = {"ts": round(time.time(), 3), **call}
+        with self.lock:
+            if self.file:
+                self.file.write(json.dumps(call, ensure_ascii=False) + "\n")
+                self.file.flush()
+            collectors = list(self.collectors)
+        for registry in collectors:
+            registry.record(call)
+
+    @contextmanager
+    def collect(self):
+        #a fresh registry that only sees the calls made inside the block
+        registry = MetricsRegistry()
+        with self.lock:
+            self.collectors.append(registry)
+        try:
+            yield registry
+        finally:
+            with self.lock:
+                self.collectors.remove(registry)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,18 @@
+# Reasoning presets shared by the GUI and the headless tools (benchmark, server).
+MODES = {
+    "⚡ Flash": {"width": 1, "depth": 1, "retries": 0, "type": "direct"},
+    "🤔 Thinking": {"width": 3, "depth": 7, "retries": 0, "type": "search"},
+    "🧠 Ultra": {"width": 4, "depth": 10, "retries": 2, "type": "search"},
+    "🌲 MCTS": {"width": 3, "depth": 12, "retries": 0, "type": "mcts", "budget": 150}
+}
+
+def make_searcher(config, engine, **kwargs):
+    #the search a preset runs, None for direct answers. kwargs go to the search (callbacks, budgets)
+    from search import BeamSearch, MCTSSearch
+    if config["type"] == "mcts":
+        kwargs.setdefault("max_calls", config["budget"])
+        return MCTSSearch(engine=engine, max_breadth=config["width"], max_depth=config["depth"], **kwargs)
+    if config["type"] == "search":
+        return BeamSearch(engine=engine, max_breadth=config["width"], max_depth=config["depth"],
+                          max_retries=config["retries"], **kwargs)
+    return None
@@ -1,66 +1,431 @@
-from tree import ReasoningNode
-from chat_engine import ChatEngine
+from tree import ReasoningNode, TranspositionTable
+from context_builder import ContextBuilder
+from chain_store import ChainStore
+from step_filter import StepFilter, STEP_FORMAT
+from engine_registry import get_engine
+from cancellation import CancelToken, SearchCancelled
 import re
-import copy
+import threading
+import math
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor, wait
+
+GRADER_RULES = ("Scoring rules:\n"
+                "1.0: Perfect logic. Essential step.\n"
+                "0.5: Valid but vague or trivial.\n"
+                "0.2: redundant or similar to previous step.\n"
+                "0.0: Logically wrong, impossible according to problem definition, contradicts history, or invalid step.\n")
+
+#output formats, enforced while decoding (GBNF) instead of parsed or rejected afterwards
+STEP_GRAMMAR = r"""
+root ::= ("idea: " | "step: " | "solution: " | "refute: ") content | "SOLVED"
+content ::= [^\x00]+
+"""
+SCORE_GRAMMAR = r"""
+root ::= "0" ("." [0-9])? | "1" (".0")?
+"""
+#a "{n}: {score}" line is at most this many tokens on top of the score itself
+SCORE_LINE_TOKENS = 4
+#tokens of the fixed instructions in the expansion and grader prompts (the problem is counted apart)
+PROMPT_TOKENS = 384
+#grade a SOLVED step needs to end the search
+SOLVED_SCORE = 0.8
+
+def score_list_grammar(count):
+    lines = ' "\\n" '.join(f'"{i}: " score' for i in range(1, count + 1))
+    return f"root ::= {lines}\nscore ::= \"0\" (\".\" [0-9])? | \"1\" (\".0\")?\n"
+
 class BeamSearch:
-    def __init__(self,engine=None,max_breadth=3,max_depth=10,max_retries=0):
+    def __init__(self,engine=None,max_breadth=3,max_depth=10,max_retries=0,scoring="logprob",batch_eval=False,
+                 parallel_sampling=False,max_resample_rounds=1,step_length=200,score_length=5,
+                 prune_text=False,resume=True,trace_summary=True,context_chunk=4,step_filter=True,
+                 cancel_token=None,on_token=None,on_event=None,layer_workers=None,max_calls=None,max_tokens=None,
+                 chain_store=None,adaptive=True,dominance=0.5,flat=0.05):
         self.root = None
         self.max_breadth = max_breadth
         self.max_depth = max_depth
         self.max_retries = max_retries
+        #"logprob": expected score from one forward pass, "text": generate the score and parse it
+        self.scoring = scoring
+        #grade all candidate steps of a node in one grader call instead of one call per step
+        self.batch_eval = batch_eval
+        #sample all candidates of a node in one batched decode, rejecting duplicates afterwards
+        self.parallel_sampling = parallel_sampling
+        self.max_resample_rounds = max_resample_rounds
+        #decode budgets per role: a step needs a sentence or two, a score needs a few tokens
+        self.step_length = step_length
+        self.score_length = score_length
+        #free the text of branches that fall out of the beam (saves memory in large searches)
+        self.prune_text = prune_text
+        #retries continue from the existing tree instead of restarting from a new root
+        self.resume = resume
+        #print the per-phase call metrics of each search, when the engine has a tracer
+        self.trace_summary = trace_summary
         if engine:
             self.engine = engine
         else:
-            self.engine = ChatEngine()
-        self.previous_history=copy.deepcopy(self.engine.history)
+            #the process wide default engine, never a second copy of the model
+            self.engine = get_engine()
+        #snapshot of the chat so far, as read-only messages that contexts can share without copying
+        self.previous_history=tuple(MappingProxyType(dict(msg)) for msg in self.engine.history)
+        #keeps deep paths inside the context window, dropping old steps context_chunk at a time
+        self.context_builder = ContextBuilder(self.engine, chunk=context_chunk)
+        #rejects malformed and near duplicate steps before grading. True, False or a StepFilter
+        self.step_filter = StepFilter() if step_filter is True else (step_filter or None)
+        #a CancelToken stops the search between engine calls and tokens (raises SearchCancelled).
+        #on_token receives the text of expansion steps while they are generated
+        self.cancel_token = cancel_token
+        self.on_token = on_token
+        #on_event(event, payload) is told about changes to the tree as they happen:
+        #node_added {node}, score_updated {node} (value, visits or text changed), expanded {node, candidates},
+        #beam_selected {nodes}, solution {history}. it runs on the search thread and should return quickly
+        self.on_event = on_event
+        #nodes of a beam layer expanded in parallel, one per engine replica by default (EnginePool)
+        self.layer_workers = layer_workers if layer_workers is not None else len(getattr(self.engine,"replicas",())) or 1
+        self.layer_executor = None
+        #the cancel token of the layer node a thread is expanding, see expand_layer
+        self.node_tokens = threading.local()
+        #compute budget over all attempts, in LLM calls and/or tokens (None: unbounded).
+        #checked between layers, so a beam search can overshoot it by up to one layer
+        self.max_calls = max_calls
+        self.max_tokens = max_tokens
+        self.budget_start = None
+        #solved chains of earlier questions (a ChainStore or a path). an exact hit is returned without
+        #a search, a similar question's chain is verified first. new solutions are stored
+        self.chain_store = ChainStore(chain_store) if isinstance(chain_store,str) else chain_store
+        self.solved_node = None
+        #adaptive beam: SOLVED candidates are graded first and a verified one skips grading its siblings,
+        #the beam narrows to half its width (at least two paths) when the leader is ahead by dominance,
+        #widens by one when the top max_breadth paths are within flat of each other, and drops paths
+        #that cannot catch the leader even with perfect grades for the remaining depth
+        self.adaptive = adaptive
+        self.dominance = dominance
+        self.flat = flat
+        self.controller = {"narrowed": 0, "widened": 0, "hopeless": 0, "early_exits": 0}
+        #controller counts updated from the threads of a parallel layer
+        self.stats_lock = threading.Lock()
     def search(self,question):
+        tracer = getattr(self.engine, "tracer", None)
+        try:
+            if not (self.trace_summary and tracer):
+                return self.solve(question)
+            with tracer.collect() as registry:
+                result = self.solve(question)
+            print(registry.summary())
+            return result
+        finally:
+            #the layer threads only live as long as the search
+            if self.layer_executor is not None:
+                self.layer_executor.shutdown()
+                self.layer_executor = None
+
+    def solve(self,question):
+        #answers from the chain store when it can, searches otherwise
+        result = None
+        cached = self.chain_store.lookup(question) if self.chain_store else None
+        if cached:
+            result = self.replay_chain(question,cached)
+            if result and cached["match"] == "exact":
+                return result
+        if not result:
+            result = self.run_attempts(question)
+        if result and self.chain_store:
+            path = []
+            node = self.solved_node
+            while node.parent is not None:
+                path.append((node.content,node.value))
+                node = node.parent
+            self.chain_store.put(question,path[::-1])
+        return result
+
+    def replay_chain(self,question,cached):
+        #rebuilds a stored chain as a path of a new tree. an exact hit is the answer, the solution of
+        #a similar question must pass the solution -> SOLVED verification step for this question first
+        self.root = ReasoningNode(question,'user')
+        self.root.value=1
+        self.root.total_value=1
+        self.transpositions = TranspositionTable()
+        self.emit("node_added",node=self.root)
+        node = self.root
+        for step,score in cached["steps"]:
+            node = self.add_state(node,step,score)
+        if cached["match"] == "exact":
+            print("chain store: solved before, reusing the stored chain")
+            return self.solution(node)
+        print(f"chain store: similar question solved before ({cached['similarity']:.0%}), verifying its solution")
+        for score,step,_ in self.expand_and_evaluate(node):
+            if step.upper()=='SOLVED' and score>=SOLVED_SCORE:
+                return self.solution(node)
+        print("chain store: the stored solution does not hold, searching")
+        return None
+
+    def run_attempts(self,question):
         old_max_depth = self.max_depth
         old_max_breadth = self.max_breadth
+        self.budget_start = dict(self.engine.usage)
         for attempt in range(self.max_retries+1):
-            result=self.run_search(question)
+            result=self.run_search(question,resume=self.resume and attempt>0)
+            table=self.transpositions
+            print(f"transpositions: {table.hits}/{table.lookups} graded states reused "
+                  f"({table.hit_rate():.0%}), {table.merges} merged nodes")
+            if self.step_filter:
+                rejected = self.step_filter.rejected
+                print(f"step filter: {self.step_filter.saved_calls()} steps scored without grading "
+                      f"({rejected['format']} malformed, {rejected['duplicate']} near duplicates)")
+            if self.adaptive:
+                controller = self.controller
+                print(f"adaptive beam: narrowed {controller['narrowed']}x, widened {controller['widened']}x, "
+                      f"{controller['hopeless']} hopeless paths dropped, {controller['early_exits']} early exits")
             if result:
                 self.max_depth = old_max_depth
                 self.max_breadth = old_max_breadth
                 return result
             else:
+                if self.budget_spent(self.budget_start):
+                    print("Compute budget spent")
+                    break
                 if attempt < self.max_retries:
                     print("Failed to find a solution. Attempting to use more compute")
                     self.max_depth +=5
                     self.max_breadth +=1
         return []
 
-    def run_search(self,question):
-        self.root = ReasoningNode(question,'user')
-        self.root.value=1
-        self.root.total_value=1
+    def run_search(self,question,resume=False):
+        #a resumed search keeps the tree, its cached expansions and grades, and walks it again
+        #with the current (wider, deeper) limits. only new breadth slots and depth cost LLM calls
+        if not (resume and self.root and self.root.content == question):
+            self.root = ReasoningNode(question,'user')
+            self.root.value=1
+            self.root.total_value=1
+            self.transpositions = TranspositionTable()
+            self.emit("node_added",node=self.root)
         best_nodes=[self.root]
         for depth in range(self.max_depth):
-            if not best_nodes:
+            if not best_nodes or self.budget_spent(self.budget_start):
                 return None
             all_step_scores=[]
-            for node in best_nodes:
-                node_steps=self.expand_logic(node)
-                step_scores=self.evaluate_steps(node,node_steps)
+            for node,step_scores in zip(best_nodes,self.expand_layer(best_nodes)):
                 for score,step,parent_node in step_scores:
-                    if step.upper()=='SOLVED' and score>=0.8:
-                        return node.get_history()
+                    if step.upper()=='SOLVED' and score>=SOLVED_SCORE:
+                        return self.solution(node)
                 all_step_scores+=step_scores#add node here
 
             #Sort by total path value, meaning the current step
             #score (x[0]) + score of path leading to step (x[2].total_value)
             all_step_scores=sorted(all_step_scores,key=lambda x: x[0]+x[2].total_value,reverse=True)
-            new_steps=all_step_scores[:self.max_breadth]
-            best_nodes=[]
-            for score,step,parent_node in new_steps:
-                new_node=parent_node.add_child(step)
-                new_node.value=score
-                new_node.total_value=score+parent_node.total_value
-                best_nodes.append(new_node)
+            width=self.max_breadth
+            if self.adaptive:
+                all_step_scores,width=self.adapt_beam(all_step_scores,depth)
+            previous_beam,best_nodes=best_nodes,[]
+            for score,step,parent_node in all_step_scores:
+                if len(best_nodes) >= width:
+                    break
+                new_node=self.add_state(parent_node,step,score)
+                #two beams reaching the same state only take one slot
+                if new_node not in best_nodes:
+                    best_nodes.append(new_node)
+            self.emit("beam_selected",nodes=list(best_nodes))
+            if self.prune_text:
+                self.prune_branches(previous_beam,best_nodes)
         return None
 
-    def expand_logic(self, current_node):
+    def adapt_beam(self,ranked,depth):
+        #returns the candidates still worth a slot and the beam width for the next layer
+        if not ranked:
+            return ranked,self.max_breadth
+        totals=[score+parent_node.total_value for score,_,parent_node in ranked]
+        #a grade is at most 1, so a path behind by more than the remaining layers cannot catch up
+        remaining=self.max_depth-depth-1
+        hopeful=[candidate for candidate,total in zip(ranked,totals) if total+remaining>=totals[0]]
+        self.controller["hopeless"]+=len(ranked)-len(hopeful)
+        top=totals[:self.max_breadth]
+        width=self.max_breadth
+        if len(top)>1 and top[0]-top[1]>=self.dominance:
+            #the leader is clearly ahead, keep it and half of the beam (at least one other path) as a fallback
+            width=min(self.max_breadth,max(2,(self.max_breadth+1)//2))
+            self.controller["narrowed"]+=1
+        elif len(top)==self.max_breadth and len(totals)>self.max_breadth and top[0]-top[-1]<=self.flat:
+            #no clear favourite, look at one more path
+            width=self.max_breadth+1
+            self.controller["widened"]+=1
+        return hopeful,width
+
+    def expand_layer(self,nodes):
+        #yields the candidates of each node in node order. a verified solution skips the remaining
+        #nodes: sequentially they are never started, in parallel they are cancelled. grades reused
+        #through the transposition table are the ones known at the start of the layer. two nodes of a
+        #layer can grade the same merged state, the table then keeps the grade written last
+        if self.layer_workers <= 1 or len(nodes) < 2:
+            for node in nodes:
+                self.check_cancelled()
+                yield self.expand_and_evaluate(node)
+            return
+        self.check_cancelled()
+        if self.layer_executor is None:
+            #threads kept for the whole search, so each stays pinned to the same engine replica
+            self.layer_executor = ThreadPoolExecutor(max_workers=self.layer_workers,thread_name_prefix="layer")
+        #one token per node under the search's, the nodes before a solution still finish
+        tokens=[CancelToken(self.cancel_token) for _ in nodes]
+        def expand(index):
+            node=nodes[index]
+            self.node_tokens.token=tokens[index]
+            try:
+                tokens[index].check()
+                step_scores=self.expand_and_evaluate(node)
+            except SearchCancelled:
+                if self.cancel_token is not None and self.cancel_token.cancelled():
+                    raise
+                #stopped for an earlier node's solution, nothing of it is kept
+                node.candidates=None
+                node.breadth=0
+                return []
+            finally:
+                self.node_tokens.token=None
+            if self.is_verified(step_scores):
+                for token in tokens[index+1:]:
+                    token.cancel()
+            return step_scores
+        self.transpositions.freeze()
+        try:
+            futures=[self.layer_executor.submit(expand,index) for index in range(len(nodes))]
+            wait(futures)
+        finally:
+            self.transpositions.thaw()
+        for future in futures:
+            yield future.result()
+
+    def is_verified(self,step_scores):
+        return any(step.upper()=='SOLVED' and score>=SOLVED_SCORE for score,step,_ in step_scores)
+
+    def add_state(self,parent_node,step,score):
+        #equivalent states share one node, turning the tree into a DAG
+        key = self.transpositions.key(step,parent_node)
+        node = self.transpositions.nodes.get(key)
+        if node is not None and node.is_pruned():
+            #a resumed search brought a pruned branch back into the beam
+            node.set_content(step)
+            self.emit("score_updated",node=node)
+        if node is None:
+            node=parent_node.add_child(step)
+            node.value=score
+            node.total_value=score+parent_node.total_value
+            self.transpositions.nodes[key]=node
+            self.emit("node_added",node=node)
+        elif parent_node not in node.parents:
+            node.add_parent(parent_node)
+            node.total_value=max(node.total_value,score+parent_node.total_value)
+            self.transpositions.merges+=1
+            self.emit("score_updated",node=node)
+        return node
+
+    def expand_and_evaluate(self,node):
+        #candidates are cached on the node, so a state reached again (or revisited by a resumed
+        #search) is not expanded twice, and a wider beam only samples the missing breadth slots.
+        #steps whose state was already graded elsewhere reuse that score instead of a grader call
+        if node.candidates is None:
+            node.candidates=[]
+        if node.breadth < self.max_breadth:
+            known=[step for _,step in node.candidates]
+            known_keys={self.transpositions.key(step,node) for step in known}
+            keys={}
+            for step in self.expand_logic(node,self.max_breadth-node.breadth,known):
+                key=self.transpositions.key(step,node)
+                if key not in known_keys:
+                    keys.setdefault(key,step)
+            node.breadth=self.max_breadth
+            scores={key: self.transpositions.get_score(key) for key in keys}
+            unknown=[keys[key] for key in keys if scores[key] is None]
+            preset={}
+            if self.step_filter:
+                unknown,preset=self.step_filter.filter(node,unknown,known)
+            graded=self.grade_candidates(node,unknown)
+            for key,step in keys.items():
+                if step not in preset and scores[key] is None and step not in graded:
+                    #not graded, a verified solution ended the search first
+                    continue
+                if step in preset:
+                    #filter verdicts depend on the neighbours, so they are not shared through the table
+                    node.candidates.append((preset[step],step))
+                    continue
+                score = scores[key] if scores[key] is not None else graded[step]
+                self.transpositions.set_score(key,score)
+                node.candidates.append((score,step))
+            self.emit("expanded",node=node,candidates=list(node.candidates))
+        return [(score,step,node) for score,step in node.candidates]
+
+    def budget_spent(self,start):
+        if start is None:
+            return False
+        calls = self.engine.usage["calls"] - start["calls"]
+        tokens = (self.engine.usage["prompt_tokens"] + self.engine.usage["completion_tokens"]
+                  - start["prompt_tokens"] - start["completion_tokens"])
+        if self.max_calls is not None and calls >= self.max_calls:
+            return True
+        return self.max_tokens is not None and tokens >= self.max_tokens
+
+    def grade_candidates(self,node,steps):
+        #with the adaptive beam, SOLVED candidates are graded first: a verified one ends the search,
+        #so its siblings are not graded at all
+        if not steps:
+            return {}
+        graded={}
+        if self.adaptive:
+            solved=[step for step in steps if step.upper()=='SOLVED']
+            if solved:
+                graded={step: score for score,step,_ in self.evaluate_steps(node,solved)}
+                if any(score>=SOLVED_SCORE for score in graded.values()):
+                    with self.stats_lock:
+                        self.controller["early_exits"]+=1
+                    return graded
+                steps=[step for step in steps if step not in graded]
+        if steps:
+            graded.update({step: score for score,step,_ in self.evaluate_steps(node,steps)})
+        return graded
+
+    def emit(self,event,**payload):
+        if self.on_event is not None:
+            self.on_event(event,payload)
+
+    def solution(self,node):
+        self.solved_node=node
+        #plain dicts, like the empty list of a failed search: callers extend chat histories with it
+        history=[dict(msg) for msg in node.get_history()]
+        self.emit("solution",history=history)
+        return history
+
+    def call_token(self):
+        return getattr(self.node_tokens,"token",None) or self.cancel_token
+
+    def check_cancelled(self):
+        token = self.call_token()
+        if token is not None:
+            token.check()
+
+    def node_context(self,node):
+        #one context per node for expansion and grading alike, so they share the cached prefix.
+        #the reserve covers the prompt (which repeats the problem) and the largest prompt + answer of
+        #any role: the "DIFFERENT from" list or the batched grader list plus a step or a score list
+        path = node.get_history()
+        reserve = (PROMPT_TOKENS + self.engine.count_tokens(path[:1])
+                   + self.step_length * (self.max_breadth + 1))
+        return self.context_builder.build(self.previous_history, path, reserve)
+
+    def prune_branches(self,previous_beam,best_nodes):
+        #drop the text of nodes that left the beam and have no surviving descendants
+        for node in previous_beam:
+            curr = node
+            while (curr.parent is not None and not curr.is_pruned() and curr not in best_nodes
+                   and all(child.is_pruned() for child in curr.children)):
+                curr.prune()
+                self.emit("score_updated",node=curr)
+                curr = curr.parent
+
+    def expand_logic(self, current_node, count=None, known_steps=()):
+        #samples count new steps (max_breadth by default) that differ from known_steps
         if current_node.depth >= self.max_depth:
             return []
+        if count is None:
+            count = self.max_breadth
 
         new_steps = []
         responses = 0
@@ -73,6 +438,7 @@ class BeamSearch:
         context_label = "Last Logical Step"
         instruction = "Provide the NEXT logical step, an idea, or a solution."
         temp=1 #should be creative
+        phase="expand"
 
         # start state
         if current_node.depth == 0:
@@ -90,6 +456,7 @@ class BeamSearch:
             )
             temp=0.1 #should be accurate and careful
             rep_penalty=1.0 #allow addressing mistakes in refute without penalty
+            phase="verify"
 
         # correction state
         elif "refute:" in last_content:
@@ -112,38 +479,68 @@ class BeamSearch:
             "2. Be concise.\n"
             "3. Do not repeat previous steps."
         )
-        base_context = (copy.deepcopy(self.previous_history) +
-                        copy.deepcopy(current_node.get_history()))
-        while responses < self.max_breadth:
+        base_context = self.node_context(current_node)
+        #every sample below (and the grading in evaluate_steps) shares this prefix
+        self.engine.cache_prefix(base_context)
+        if self.parallel_sampling:
+            return self.sample_parallel(base_context + [{"role": "user", "content": base_prompt}],
+                                        temp, rep_penalty, count, known_steps, phase, current_node.depth)
+        while responses < count:
             prompt = base_prompt
-            if new_steps:
+            if new_steps or known_steps:
                 prompt += "\nIMPORTANT: Output must be DIFFERENT from:\n"
-                prompt += "\n".join([f"- {step}" for step in new_steps])
+                prompt += "\n".join([f"- {step}" for step in list(known_steps) + new_steps])
 
             context = base_context.copy()
             context.append({"role": "user", "content": prompt})
 
-            output = self.engine.generate_answer(context, temperature=temp,repeat_penalty=rep_penalty)
+            output = self.engine.generate_answer(context, answer_length=self.step_length, grammar=STEP_GRAMMAR,
+                                                 temperature=temp,repeat_penalty=rep_penalty,
+                                                 phase=phase,depth=current_node.depth,
+                                                 cancel=self.call_token(),on_token=self.on_token)
             responses += 1
             if output:
                 response_text = output['choices'][0]['message']['content'].strip()
                 # Basic cleanup to prevent formatting errors
-                if response_text not in new_steps:
+                if response_text not in new_steps and response_text not in known_steps:
                     new_steps.append(response_text)
         return new_steps
 
+    def sample_parallel(self,context,temp,rep_penalty,count,known_steps=(),phase="expand",depth=None):
+        #decode all candidates from the same prompt at once. diversity is enforced afterwards
+        #by dropping duplicates and resampling the missing slots, instead of growing the prompt
+        new_steps = []
+        seen = {" ".join(step.lower().split()) for step in known_steps}
+        for attempt in range(self.max_resample_rounds + 1):
+            missing = count - len(new_steps)
+            if missing <= 0:
+                break
+            #the batched sampler cannot apply a grammar, so the step format is enforced by rejection
+            outputs = self.engine.generate_batch([context] * missing, answer_length=self.step_length,
+                                                 temperature=temp, repeat_penalty=rep_penalty,
+                                                 phase=phase, depth=depth, cancel=self.call_token())
+            for output in outputs:
+                if output:
+                    response_text = output['choices'][0]['message']['content'].strip()
+                    key = " ".join(response_text.lower().split())
+                    if STEP_FORMAT.match(response_text) and key not in seen:
+                        seen.add(key)
+                        new_steps.append(response_text)
+        return new_steps[:count]
+
     def evaluate_steps(self,current_node,new_steps):
+        if self.batch_eval and len(new_steps) > 1:
+            return self.evaluate_steps_batch(current_node,new_steps)
+        return self.evaluate_each(current_node,new_steps)
+
+    def evaluate_each(self,current_node,new_steps):
         user_problem=current_node.get_history()[0]['content']
         step_scores=[]
-        base_context = (copy.deepcopy(self.previous_history) +
-                        copy.deepcopy(current_node.get_history()))
+        base_context = self.node_context(current_node)
+        self.engine.cache_prefix(base_context)
         for step in new_steps:
             eval_prompt = ("You are a strict logic grader. Rate the last step on a scale of 0.0 to 1.0.\n"
-                           "Scoring rules:\n"
-                           "1.0: Perfect logic. Essential step.\n"
-                           "0.5: Valid but vague or trivial.\n"
-                           "0.2: redundant or similar to previous step.\n"
-                           "0.0: Logically wrong, impossible according to problem definition, contradicts history, or invalid step.\n"
+                           f"{GRADER_RULES}"
                            f"Problem: {user_problem}\n"
                            f"Last Logical Step: {step}\n"
                            "Constraints:\n"
@@ -155,16 +552,73 @@ class BeamSearch:
             context=base_context.copy()
             context.append({"role": "assistant", "content": step})
             context.append({"role": "user", "content": eval_prompt})
-            evaluation=self.engine.generate_answer(context,temperature=0.1)
-            if evaluation:
-                evaluation_text = evaluation['choices'][0]['message']['content'].strip()
-                score= self.text_to_score(evaluation_text)
-                step_scores.append((score, step, current_node))
-            else:
-                #failed to evaluate, add default score
-                step_scores.append((self.text_to_score(''), step, current_node))
+            step_scores.append((self.score_context(context,current_node.depth), step, current_node))
         return step_scores
 
+    def score_context(self,context,depth=None):
+        if self.scoring == "logprob":
+            score = self.engine.score_logprobs(context,phase="evaluate",depth=depth,cancel=self.call_token())
+            if score is not None:
+                return score
+        #text scoring, also the fallback when the model did not answer with a number
+        evaluation=self.engine.generate_answer(context,answer_length=self.score_length,grammar=SCORE_GRAMMAR,
+                                               stop=["\n"],temperature=0.1,phase="evaluate",depth=depth,
+                                               cancel=self.call_token())
+        if evaluation:
+            evaluation_text = evaluation['choices'][0]['message']['content'].strip()
+            return self.text_to_score(evaluation_text)
+        #failed to evaluate, use default score
+        return self.text_to_score('')
+
+    def evaluate_steps_batch(self,current_node,new_steps):
+        #grade all candidate steps of a node with a single grader prompt
+        user_problem=current_node.get_history()[0]['content']
+        base_context = self.node_context(current_node)
+        self.engine.cache_prefix(base_context)
+        candidates = "".join(f"Step {i}: {step}\n" for i, step in enumerate(new_steps, 1))
+        eval_prompt = ("You are a strict logic grader. Rate each candidate next step below on a scale of 0.0 to 1.0.\n"
+                       f"{GRADER_RULES}"
+                       f"Problem: {user_problem}\n"
+                       f"Candidate Steps:\n{candidates}"
+                       "Constraints:\n"
+                       "1. verify carefully that each step is correct, valid, and doesnt result in a contradiction "
+                       "with previous logical steps or with the original problem.\n"
+                       "2. Grade every step on its own, as if it was the only next step.\n"
+                       "3. Penalize repetition of previous steps heavily.\n"
+                       f"4. Output exactly {len(new_steps)} lines, one per step, in the format '{{number}}: {{score}}'. "
+                       "dont include any other words in your output.")
+        context=base_context.copy()
+        context.append({"role": "user", "content": eval_prompt})
+        scores = {}
+        if self.scoring == "logprob":
+            #teacher-force the score list line by line. each line reuses the kv cache of the
+            #previous ones, so grading costs one prefill plus a few tokens per step
+            answer = ""
+            for i in range(1, len(new_steps) + 1):
+                score = self.engine.score_logprobs(context, answer_prefix=answer + f"{i}: ",
+                                                   phase="evaluate", depth=current_node.depth,
+                                                   cancel=self.call_token())
+                if score is None:
+                    break
+                scores[i] = score
+                answer += f"{i}: {score:.1f}\n"
+        if len(scores) < len(new_steps):
+            evaluation = self.engine.generate_answer(context,
+                                                     answer_length=(self.score_length+SCORE_LINE_TOKENS)*len(new_steps),
+                                                     grammar=score_list_grammar(len(new_steps)), temperature=0.1,
+                                                     phase="evaluate", depth=current_node.depth,
+                                                     cancel=self.call_token())
+            if evaluation:
+                parsed = self.text_to_scores(evaluation['choices'][0]['message']['content'], len(new_steps))
+                scores = {**parsed, **scores}
+        #steps missing from the batched answer are graded on their own
+        missing = [step for i, step in enumerate(new_steps, 1) if i not in scores]
+        fallback = {}
+        if missing:
+            fallback = {step: score for score, step, _ in self.evaluate_each(current_node, missing)}
+        return [(scores[i] if i in scores else fallback[step], step, current_node)
+                for i, step in enumerate(new_steps, 1)]
+
     def text_to_score(self,text):
         default_score=0.5
         if not text:
@@ -177,4 +631,87 @@ class BeamSearch:
         #and a common misbehaviour of "from a scale of 0 to 1 i score this a X" output
         likely_score=float(numbers[-1])
         score= likely_score if 0<=likely_score<=1 else default_score
-        return score
\ No newline at end of file
+        return score
+
+    def text_to_scores(self,text,count):
+        #parse a "{number}: {score}" list, only keeping well formed lines inside the 0-1 range
+        scores={}
+        for index, value in re.findall(r"^\D*?(\d+)\s*[:.)-]\s*(\d+\.?\d*)", text, re.MULTILINE):
+            index, value = int(index), float(value)
+            if 1 <= index <= count and 0 <= value <= 1 and index not in scores:
+                scores[index] = value
+        return scores
+class MCTSSearch(BeamSearch):
+    #monte carlo tree search on top of the beam search primitives: UCT selection, expansion with
+    #expand_logic, grading with evaluate_steps and backpropagation of the best new grade.
+    #bounded by a budget of LLM calls and/or tokens instead of depth x breadth
+    def __init__(self,engine=None,max_breadth=3,max_depth=10,max_calls=200,max_tokens=None,
+                 exploration=1.0,max_iterations=1000,**kwargs):
+        super().__init__(engine,max_breadth,max_depth,max_retries=0,max_calls=max_calls,max_tokens=max_tokens,**kwargs)
+        self.exploration = exploration
+        #guards against spinning on a tree where every leaf is terminal
+        self.max_iterations = max_iterations
+
+    def run_attempts(self,question):
+        result=self.run_search(question)
+        return result if result else []
+
+    def run_search(self,question,resume=False):
+        self.root = ReasoningNode(question,'user')
+        self.root.value=1
+        self.transpositions = TranspositionTable()
+        self.emit("node_added",node=self.root)
+        start = dict(self.engine.usage)
+        for iteration in range(self.max_iterations):
+            self.check_cancelled()
+            if self.budget_spent(start):
+                break
+            leaf = self.select(self.root)
+            reward = leaf.value
+            if not self.is_terminal(leaf):
+                step_scores = self.expand_and_evaluate(leaf)
+                for score,step,parent_node in step_scores:
+                    if step.upper()=='SOLVED' and score>=SOLVED_SCORE:
+                        return self.solution(leaf)
+                children = [self.add_state(leaf,step,score) for score,step,_ in step_scores]
+                if children:
+                    reward = max(child.value for child in children)
+            self.backpropagate(leaf,reward)
+        return None
+
+    def is_terminal(self,node):
+        dead_end = node.candidates == [] and node.breadth >= self.max_breadth
+        return dead_end or node.depth >= self.max_depth or node.content.strip().upper()=='SOLVED'
+
+    def select(self,node):
+        #walk down by UCT until reaching a node that was not expanded yet
+        while node.children and node.candidates is not None:
+            node = max(node.children, key=lambda child: self.uct(node,child))
+        return node
+
+    def uct(self,parent,child):
+        #unvisited children use their grade as the value estimate
+        mean = child.total_value/child.visits if child.visits else child.value
+        return mean + self.exploration*math.sqrt(math.log(parent.visits+1)/(child.visits+1))
+
+    def backpropagate(self,node,reward):
+        #merged states are credited along the path they were first found on
+        while node:
+            node.visits += 1
+            node.total_value += reward
+            self.emit("score_updated",node=node)
+            node = node.parent
+
+    def add_state(self,parent_node,step,score):
+        #like the beam version, but total_value holds backed up rewards instead of the path sum
+        key = self.transpositions.key(step,parent_node)
+        node = self.transpositions.nodes.get(key)
+        if node is None:
+            node=parent_node.add_child(step)
+            node.value=score
+            self.transpositions.nodes[key]=node
+            self.emit("node_added",node=node)
+        elif parent_node not in node.parents:
+            node.add_parent(parent_node)
+            self.transpositions.merges+=1
+        return node
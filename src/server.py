@@ -0,0 +1,380 @@
+import argparse
+import itertools
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from async_api import AsyncChatEngine, ScheduledEngine
+from benchmark import BENCHMARK_DIR, load_corpus
+from chain_store import ChainStore
+from cancellation import CancelToken, SearchCancelled
+from metrics import MetricsRegistry
+from modes import MODES, make_searcher
+from stub_engine import StubEngine
+
+#local HTTP server sharing one loaded model between clients.
+#  python server.py --model ../models/model.gguf --port 8000
+#  python server.py --engine stub                 (scripted engine, no model needed)
+#endpoints:
+#  POST /v1/chat/completions   OpenAI style chat. "model" picks a mode: a Flash/plain model name answers
+#                              directly (stream=true sends server-sent events), a search mode
+#                              ("thinking", "ultra", "mcts") runs a search on the last user message
+#  POST /v1/reasoning          {"question", "mode", "messages"?, "max_calls"?, "max_tokens"?} -> the solution chain
+#                              (for searches max_tokens is the token budget, for direct answers the answer length)
+#  GET  /v1/models             the modes
+#  GET  /v1/stats              queue depth, request counters and latency percentiles
+#  GET  /health
+#requests beyond max_active running + max_queued waiting are refused with 429. every request runs
+#under a compute budget (LLM calls and tokens), capped by the server limits. engine calls of all
+#running requests share the model round robin (async_api.InferenceScheduler)
+
+class AdmissionQueue:
+    #at most max_active requests run at once, up to max_queued more wait for a slot
+    def __init__(self, max_active=4, max_queued=16, timeout=60.0):
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self.active = 0
+        self.queued = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        #"ok", "full" (refused right away) or "timeout" (waited too long for a slot)
+        with self.cond:
+            if self.active >= self.max_active and self.queued >= self.max_queued:
+                return "full"
+            self.queued += 1
+            try:
+                if not self.cond.wait_for(lambda: self.active < self.max_active, self.timeout):
+                    return "timeout"
+            finally:
+                self.queued -= 1
+            self.active += 1
+            return "ok"
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify()
+
+    def depth(self):
+        with self.cond:
+            return {"active": self.active, "queued": self.queued,
+                    "max_active": self.max_active, "max_queued": self.max_queued}
+
+
+class RequestError(Exception):
+    def __init__(self, status, message, kind="invalid_request_error"):
+        super().__init__(message)
+        self.status = status
+        self.kind = kind
+
+
+class ReasoningServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, engine, max_active=4, max_queued=16, queue_timeout=60.0, max_calls=300,
+                 max_tokens=None, chain_store=None):
+        super().__init__(address, RequestHandler)
+        self.engine = AsyncChatEngine(engine, max_searches=max_active)
+        self.admission = AdmissionQueue(max_active, max_queued, queue_timeout)
+        #server wide caps, a request can only ask for less
+        self.max_calls = max_calls
+        self.max_tokens = max_tokens
+        #solved chains shared by all searches (a ChainStore or a path), None to always search
+        self.chain_store = ChainStore(chain_store) if isinstance(chain_store, str) else chain_store
+        self.metrics = MetricsRegistry()
+        self.requests = itertools.count(1)
+        self.started = time.time()
+
+    def close(self):
+        self.server_close()
+        self.engine.close()
+
+    def stats(self):
+        snapshot = self.metrics.snapshot()
+        if self.chain_store is not None:
+            snapshot["chain_store"] = self.chain_store.stats()
+        return {"uptime_s": round(time.time() - self.started, 1), "queue": self.admission.depth(),
+                "pending_engine_calls": self.engine.scheduler.pending(), "engine_usage": dict(self.engine.engine.usage),
+                **snapshot}
+
+    def budget(self, body, config):
+        #the request's budget (the preset's by default), never above the server's
+        limits = {}
+        defaults = {"max_calls": config.get("budget")}
+        for name, cap in (("max_calls", self.max_calls), ("max_tokens", self.max_tokens)):
+            value = body.get(name)
+            #json true/false are ints to python
+            if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value <= 0):
+                raise RequestError(400, f"{name} must be a positive integer")
+            value = defaults.get(name) if value is None else value
+            limits[name] = cap if value is None else (value if cap is None else min(value, cap))
+        return limits
+
+    def client_engine(self, messages=None):
+        #engine view for one request: its own history and usage, calls queued round robin
+        client = ("http", next(self.requests))
+        history = self.engine.history if messages is None else messages
+        return client, ScheduledEngine(self.engine, client, history)
+
+
+def resolve_mode(name):
+    #"thinking", "🤔 Thinking" -> the MODES key. anything else (e.g. a model name) is a direct answer
+    for mode_name in MODES:
+        if name == mode_name or str(name).lower() == mode_name.split()[-1].lower():
+            return mode_name
+    return next(mode_name for mode_name, config in MODES.items() if config["type"] == "direct")
+
+def parse_messages(messages):
+    if not isinstance(messages, list) or not messages:
+        raise RequestError(400, "messages must be a non-empty list")
+    parsed = []
+    for msg in messages:
+        if not isinstance(msg, dict) or msg.get("role") not in ("system", "user", "assistant") \
+                or not isinstance(msg.get("content"), str):
+            raise RequestError(400, "every message needs a role (system, user, assistant) and text content")
+        parsed.append({"role": msg["role"], "content": msg["content"]})
+    return parsed
+
+def with_system(engine, messages):
+    #requests without a system prompt get the engine's
+    if not messages or messages[0]["role"] != "system":
+        return [dict(msg) for msg in engine.history if msg["role"] == "system"][:1] + messages
+    return messages
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        sys.stderr.write(f"{self.address_string()} {format % args}\n")
+
+    def send_json(self, status, payload, headers=()):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status, message, kind, headers=()):
+        self.send_json(status, {"error": {"message": message, "type": kind}}, headers)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            raise RequestError(400, "body is not valid JSON")
+        if not isinstance(body, dict):
+            raise RequestError(400, "body must be a JSON object")
+        return body
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, {"status": "ok"})
+        elif self.path == "/v1/models":
+            self.send_json(200, {"object": "list", "data": [
+                {"id": mode_name.split()[-1].lower(), "object": "model", "owned_by": "local", "mode": mode_name}
+                for mode_name in MODES]})
+        elif self.path == "/v1/stats":
+            self.send_json(200, self.server.stats())
+        else:
+            self.send_error_json(404, f"no route {self.path}", "not_found")
+
+    def do_POST(self):
+        routes = {"/v1/chat/completions": self.chat_completions, "/v1/reasoning": self.reasoning}
+        handler = routes.get(self.path)
+        if handler is None:
+            self.send_error_json(404, f"no route {self.path}", "not_found")
+            return
+        server = self.server
+        endpoint = self.path.rsplit("/", 1)[-1]
+        start = time.perf_counter()
+        status = 500
+        try:
+            body = self.read_body()
+            admitted = server.admission.acquire()
+            if admitted != "ok":
+                status = 429 if admitted == "full" else 503
+                server.metrics.inc("rejected", phase=endpoint)
+                self.send_error_json(status, "server is busy, retry later", "rate_limit_exceeded",
+                                     headers=[("Retry-After", "1")])
+                return
+            server.metrics.observe("queue_wait_s", time.perf_counter() - start, phase=endpoint)
+            try:
+                status = handler(body)
+            finally:
+                server.admission.release()
+        except RequestError as e:
+            status = e.status
+            self.send_error_json(e.status, str(e), e.kind)
+        except (BrokenPipeError, ConnectionResetError):
+            #the client went away
+            status = 499
+        except Exception as e:
+            print(f"\nError handling {self.path}: {e}")
+            self.send_error_json(500, str(e), "server_error")
+        finally:
+            server.metrics.inc("requests", phase=endpoint)
+            server.metrics.inc(f"status_{status}", phase=endpoint)
+            server.metrics.observe("latency_s", time.perf_counter() - start, phase=endpoint)
+
+    def reasoning(self, body):
+        question = body.get("question")
+        if not isinstance(question, str) or not question.strip():
+            raise RequestError(400, "question must be a non-empty string")
+        mode_name = resolve_mode(body.get("mode", "thinking"))
+        messages = parse_messages(body["messages"]) if body.get("messages") else None
+        result = self.run_mode(mode_name, question, messages, body)
+        self.send_json(200, result)
+        return 200
+
+    def chat_completions(self, body):
+        messages = parse_messages(body.get("messages"))
+        mode_name = resolve_mode(body.get("model", ""))
+        if MODES[mode_name]["type"] == "direct":
+            return self.direct_answer(mode_name, messages, body)
+        if messages[-1]["role"] != "user":
+            raise RequestError(400, "the last message must be the user's question")
+        result = self.run_mode(mode_name, messages[-1]["content"], messages[:-1], body)
+        content = "\n".join(result["steps"])
+        self.send_json(200, {
+            "id": f"chatcmpl-{result['id']}", "object": "chat.completion", "created": int(time.time()),
+            "model": mode_name.split()[-1].lower(),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                         "finish_reason": "stop" if result["solved"] else "length"}],
+            "usage": self.usage(result["usage"]),
+            "reasoning": {"solved": result["solved"], "steps": result["steps"]}})
+        return 200
+
+    def usage(self, usage):
+        return {"prompt_tokens": usage["prompt_tokens"], "completion_tokens": usage["completion_tokens"],
+                "total_tokens": usage["prompt_tokens"] + usage["completion_tokens"], "calls": usage["calls"]}
+
+    def run_mode(self, mode_name, question, messages, body):
+        server = self.server
+        config = MODES[mode_name]
+        limits = server.budget(body, config)
+        client, engine = server.client_engine(None if messages is None else with_system(server.engine, messages))
+        start = time.perf_counter()
+        if config["type"] == "direct":
+            #a direct answer spends its token budget on the answer length
+            answer_length = engine.answer_length
+            if limits["max_tokens"] is not None:
+                answer_length = min(limits["max_tokens"], answer_length)
+            response = engine.generate_answer(engine.history + [{"role": "user", "content": question}],
+                                              answer_length=answer_length, temperature=0.7, phase="flash")
+            answer = response["choices"][0]["message"]["content"] if response else ""
+            steps, solved = [answer], bool(answer)
+        else:
+            searcher = make_searcher(config, engine, trace_summary=False, chain_store=server.chain_store, **limits)
+            result = searcher.search(question)
+            steps, solved = [msg["content"] for msg in result[1:]], bool(result)
+        return {"id": client[1], "mode": mode_name, "question": question, "solved": solved, "steps": steps,
+                "answer": steps[-1] if steps else "", "usage": dict(engine.usage),
+                "latency_s": round(time.perf_counter() - start, 3)}
+
+    def direct_answer(self, mode_name, messages, body):
+        server = self.server
+        max_tokens = body.get("max_tokens")
+        if max_tokens is not None and (not isinstance(max_tokens, int) or isinstance(max_tokens, bool) or max_tokens <= 0):
+            raise RequestError(400, "max_tokens must be a positive integer")
+        answer_length = min(max_tokens or server.engine.engine.answer_length, server.engine.engine.answer_length)
+        kwargs = {"answer_length": answer_length, "temperature": body.get("temperature", 0.7), "phase": "flash"}
+        if body.get("stop"):
+            kwargs["stop"] = body["stop"]
+        client, engine = server.client_engine(with_system(server.engine, messages))
+        created = int(time.time())
+        completion_id = f"chatcmpl-{client[1]}"
+        model = mode_name.split()[-1].lower()
+        if not body.get("stream"):
+            response = engine.generate_answer(engine.history, **kwargs)
+            if not response:
+                raise RequestError(500, "generation failed", "server_error")
+            self.send_json(200, {"id": completion_id, "object": "chat.completion", "created": created, "model": model,
+                                 "choices": [{"index": 0, "message": response["choices"][0]["message"],
+                                              "finish_reason": response["choices"][0].get("finish_reason", "stop")}],
+                                 "usage": self.usage(engine.usage)})
+            return 200
+
+        #server-sent events: the tokens are handed over from the inference thread through a queue,
+        #so a slow client never stalls the model. a client that disconnects cancels the generation
+        pieces = queue.Queue()
+        cancel = CancelToken()
+        call = server.engine.search_executor.submit(engine.generate_answer, engine.history, cancel=cancel,
+                                                    on_token=pieces.put, **kwargs)
+        call.add_done_callback(lambda _: pieces.put(None))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def event(delta, finish_reason=None):
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                     "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        try:
+            event({"role": "assistant"})
+            while True:
+                piece = pieces.get()
+                if piece is None:
+                    break
+                event({"content": piece})
+            response = call.result()
+            finish_reason = response["choices"][0].get("finish_reason", "stop") if response else "stop"
+            event({}, finish_reason)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except SearchCancelled:
+            pass
+        finally:
+            cancel.cancel()
+        return 200
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local HTTP server for chat and reasoning searches")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--engine", choices=["stub", "gguf"], default="gguf")
+    parser.add_argument("--model", help="path to a GGUF model")
+    parser.add_argument("--corpus", default=os.path.join(BENCHMARK_DIR, "puzzles.jsonl"),
+                        help="scripted puzzles for the stub engine")
+    parser.add_argument("--max-active", type=int, default=4, help="requests running at once")
+    parser.add_argument("--max-queued", type=int, default=16, help="requests waiting for a slot, more get 429")
+    parser.add_argument("--queue-timeout", type=float, default=60.0, help="seconds a request may wait (503 after)")
+    parser.add_argument("--max-calls", type=int, default=300, help="LLM call budget per request")
+    parser.add_argument("--max-tokens", type=int, help="token budget per request")
+    parser.add_argument("--chain-store", help="sqlite file of solved chains, reused for repeated questions")
+    args = parser.parse_args()
+
+    if args.engine == "stub" and not args.model:
+        engine = StubEngine(load_corpus(args.corpus))
+    else:
+        from chat_engine import ChatEngine
+        engine = ChatEngine(**({"model_path": args.model} if args.model else {}))
+    server = ReasoningServer((args.host, args.port), engine, max_active=args.max_active, max_queued=args.max_queued,
+                             queue_timeout=args.queue_timeout, max_calls=args.max_calls, max_tokens=args.max_tokens,
+                             chain_store=args.chain_store)
+    print(f"serving {engine.model_path} on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
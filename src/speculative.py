@@ -0,0 +1,85 @@
+import numpy as np
+import llama_cpp
+from llama_cpp import Llama
+from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
+
+#draft models for speculative decoding in ChatEngine. llama verifies the drafted tokens in one
+#forward pass and keeps the prefix it would have sampled anyway, so the output is unchanged and
+#every accepted token saves a decode step.
+#  prompt lookup: drafts the continuation of the latest n-gram match in the prompt, free, and a good
+#                 fit for steps that quote the problem statement or earlier steps
+#  GGUF draft:    greedy drafts from a small model with the same vocabulary (e.g. Qwen2.5 0.5B for 7B)
+
+class GGUFDraftModel(LlamaDraftModel):
+    def __init__(self, model_path, num_pred_tokens=8, n_ctx=4096, n_gpu_layers=-1):
+        self.num_pred_tokens = num_pred_tokens
+        self.llm = Llama(model_path=model_path, n_gpu_layers=n_gpu_layers, n_ctx=n_ctx, verbose=False)
+
+    def __call__(self, input_ids, **kwargs):
+        #the draft model keeps its kv cache between calls, so it only evaluates the new tokens
+        tokens = input_ids.tolist()
+        evaluated = Llama.longest_token_prefix(self.llm._input_ids.tolist(), tokens)
+        self.llm.n_tokens = min(evaluated, len(tokens) - 1)
+        self.llm.eval(tokens[self.llm.n_tokens:])
+        draft = []
+        room = self.llm.n_ctx() - self.llm.n_tokens
+        for _ in range(min(self.num_pred_tokens, room)):
+            token = int(np.argmax(self.llm._scores[-1, :]))
+            if llama_cpp.llama_token_is_eog(self.llm.model, token):
+                break
+            draft.append(token)
+            if len(draft) < room:
+                self.llm.eval([token])
+        return np.array(draft, dtype=np.intc)
+
+
+class DraftCounter(LlamaDraftModel):
+    #wraps a draft model and counts how many drafted tokens the target model accepted.
+    #a draft is resolved at the next draft call: the tokens llama kept since then start with
+    #the accepted part of the draft, followed by the token it sampled instead
+    def __init__(self, draft):
+        self.draft = draft
+        self.pending = None
+        self.drafted = 0
+        self.accepted = 0
+
+    def __call__(self, input_ids, **kwargs):
+        self.resolve(input_ids)
+        draft = np.asarray(self.draft(input_ids, **kwargs), dtype=np.intc)
+        self.pending = (len(input_ids), draft)
+        return draft
+
+    def resolve(self, input_ids):
+        if self.pending is None:
+            return
+        start, draft = self.pending
+        self.pending = None
+        if len(input_ids) <= start:
+            return
+        new = input_ids[start:]
+        accepted = 0
+        while accepted < min(len(draft), len(new)) and new[accepted] == draft[accepted]:
+            accepted += 1
+        self.drafted += len(draft)
+        self.accepted += accepted
+
+    def finish(self):
+        #the draft of the last step was never verified (the answer ended or hit a stop), so it is not counted
+        self.pending = None
+
+    def stats(self):
+        return {"drafted": self.drafted, "accepted": self.accepted,
+                "acceptance_rate": round(self.accepted / self.drafted, 3) if self.drafted else None}
+
+
+def make_draft_model(kind="prompt_lookup", draft_model_path=None, num_pred_tokens=10, max_ngram_size=2,
+                     n_ctx=4096):
+    if kind == "prompt_lookup":
+        draft = LlamaPromptLookupDecoding(max_ngram_size=max_ngram_size, num_pred_tokens=num_pred_tokens)
+    elif kind == "draft":
+        if not draft_model_path:
+            raise ValueError("speculative='draft' needs a draft_model_path")
+        draft = GGUFDraftModel(draft_model_path, num_pred_tokens=num_pred_tokens, n_ctx=n_ctx)
+    else:
+        raise ValueError(f"unknown speculative decoding kind {kind!r}, expected 'prompt_lookup' or 'draft'")
+    return DraftCounter(draft)
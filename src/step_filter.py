@@ -0,0 +1,68 @@
+import re
+import threading
+from functools import lru_cache
+from tree import normalize_step
+
+#LLM-free checks between expansion and grading. a candidate step that breaks the output format,
+#or that restates an ancestor or sibling step in other words, gets a preset score instead of a
+#grader call. similarity is the jaccard index of word n-gram shingles, exact rather than MinHash
+#estimated, since steps are a sentence or two and a node has only a handful of neighbours
+
+STEP_FORMAT = re.compile(r"^(idea|step|solution|refute):\s*\S|^SOLVED$", re.IGNORECASE)
+PREFIXES = re.compile(r"^(idea|step|solution|refute):\s*", re.IGNORECASE)
+
+@lru_cache(maxsize=4096)
+def shingles(text, n=3):
+    #word n-grams of the normalized step, without its format prefix
+    words = re.sub(r"[^\w\s]", " ", PREFIXES.sub("", normalize_step(text))).split()
+    if len(words) <= n:
+        return frozenset([tuple(words)])
+    return frozenset(tuple(words[i:i + n]) for i in range(len(words) - n + 1))
+
+def similarity(a, b, n=3):
+    a, b = shingles(a, n), shingles(b, n)
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+class StepFilter:
+    def __init__(self, threshold=0.8, ngram=3, invalid_score=0.0, duplicate_score=0.1):
+        #steps at least this similar to an ancestor or sibling are near duplicates
+        self.threshold = threshold
+        self.ngram = ngram
+        self.invalid_score = invalid_score
+        self.duplicate_score = duplicate_score
+        self.rejected = {"format": 0, "duplicate": 0}
+        #the nodes of a parallel beam layer are filtered on several threads
+        self.lock = threading.Lock()
+
+    def saved_calls(self):
+        return sum(self.rejected.values())
+
+    def check(self, step, neighbours):
+        #returns the preset score of a rejected step, or None if the step should be graded
+        if not STEP_FORMAT.match(step.strip()):
+            with self.lock:
+                self.rejected["format"] += 1
+            return self.invalid_score
+        if step.strip().upper() == "SOLVED":
+            return None
+        for other in neighbours:
+            if similarity(step, other, self.ngram) >= self.threshold:
+                with self.lock:
+                    self.rejected["duplicate"] += 1
+                return self.duplicate_score
+        return None
+
+    def filter(self, node, steps, siblings=()):
+        #splits steps into (to grade, {step: preset score}). steps are compared to the path
+        #leading to node (without the problem), to its graded siblings and to each other
+        ancestors = [msg["content"] for msg in node.get_history()[1:]]
+        neighbours = ancestors + list(siblings)
+        accepted, rejected = [], {}
+        for step in steps:
+            score = self.check(step, neighbours)
+            if score is None:
+                accepted.append(step)
+                neighbours.append(step)
+            else:
+                rejected[step] = score
+        return accepted, rejected
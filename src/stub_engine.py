@@ -0,0 +1,191 @@
+import hashlib
+import re
+import time
+
+#deterministic stand-in for ChatEngine, used by the benchmark (and anything else that needs to run
+#a search without a model). it answers from a scripted puzzle corpus: expansion prompts get the next
+#scripted step, a distractor or a wrong solution, grader prompts get a score for the graded step.
+#every choice is a hash of the prompt, so the same search always makes the same calls.
+#token counts are estimated as 4 characters per token.
+
+class StubEngine:
+    def __init__(self, puzzles=(), good_rate=0.6, wrong_solution_rate=0.15, flash_rate=0.3, seed=0, tracer=None,
+                 delay=0.0):
+        self.model_path = "stub"
+        self.context_length = 4096
+        self.answer_length = 500
+        #chance that an expansion follows the script, or jumps to a wrong answer instead
+        self.good_rate = good_rate
+        self.wrong_solution_rate = wrong_solution_rate
+        #chance that a direct (flash) answer is correct
+        self.flash_rate = flash_rate
+        self.seed = seed
+        #seconds each call takes, to simulate model latency (e.g. for parallel replicas)
+        self.delay = delay
+        self.puzzles = {puzzle["question"]: puzzle for puzzle in puzzles}
+        self.usage = {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        self.tracer = tracer
+        self.history = [
+            {"role": "system",
+             "content": ("You are a helpful, logical assistant."
+                        "Always answer directly and concisely."
+                        "If a question is complex, break it down step-by-step before concluding.")
+            }
+        ]
+
+    def _uniform(self, *parts):
+        digest = hashlib.sha256(repr((self.seed,) + parts).encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big") / 2 ** 64
+
+    def _tokens(self, text):
+        return len(text) // 4 + 1
+
+    def count_tokens(self, messages):
+        return sum(self._tokens(msg["content"]) for msg in messages)
+
+    def _record_usage(self, context, text, kind="chat", phase=None, depth=None, start=None):
+        prompt_tokens = self.count_tokens(context)
+        completion_tokens = self._tokens(text)
+        if self.delay:
+            time.sleep(self.delay)
+        self.usage["calls"] += 1
+        self.usage["prompt_tokens"] += prompt_tokens
+        self.usage["completion_tokens"] += completion_tokens
+        if self.tracer is not None:
+            self.tracer.record(kind=kind, phase=phase, depth=depth, prompt_tokens=prompt_tokens,
+                               completion_tokens=completion_tokens,
+                               latency_s=round(time.perf_counter() - start, 6) if start else None)
+
+    def _puzzle(self, context):
+        for msg in reversed(context):
+            if msg["role"] == "user" and msg["content"] in self.puzzles:
+                return self.puzzles[msg["content"]], msg
+        return None, None
+
+    def _path(self, context, question):
+        #assistant steps between the question and the current prompt
+        steps = []
+        found = False
+        for msg in context:
+            if msg is question:
+                found = True
+            elif found and msg["role"] == "assistant":
+                steps.append(msg["content"])
+        return steps
+
+    def _solution(self, puzzle):
+        return f"solution: {puzzle['solution']}"
+
+    def _wrong_solution(self, puzzle):
+        return f"solution: {puzzle['wrong']}"
+
+    def _is_correct(self, puzzle, step):
+        text = step.lower()
+        return all(part.lower() in text for part in puzzle["answer"])
+
+    def _grade(self, puzzle, path, step):
+        jitter = self._uniform("grade", step, len(path)) / 10
+        if puzzle is None:
+            return 0.5
+        if step == "SOLVED":
+            return 0.85 + jitter if path and self._is_correct(puzzle, path[-1]) else 0.1
+        if step.startswith("solution:"):
+            #the grader is sometimes fooled by a confident wrong answer
+            return 0.85 + jitter if self._is_correct(puzzle, step) else 0.2 + jitter * 2
+        if step.startswith("refute:"):
+            return 0.5
+        if step in puzzle["steps"]:
+            return 0.8 + jitter
+        return 0.1 + jitter * 2
+
+    def _expand(self, puzzle, path, sample):
+        last = path[-1] if path else ""
+        if last.startswith("solution:"):
+            if self._is_correct(puzzle, last):
+                return "SOLVED"
+            return "refute: the proposed solution contradicts the problem statement"
+        done = sum(1 for step in path if step in puzzle["steps"])
+        good = puzzle["steps"][done] if done < len(puzzle["steps"]) else self._solution(puzzle)
+        if last.startswith("refute:"):
+            return good
+        roll = self._uniform("expand", puzzle["question"], tuple(path), sample)
+        if roll < self.good_rate:
+            return good
+        if roll < self.good_rate + self.wrong_solution_rate:
+            return self._wrong_solution(puzzle)
+        return f"step: try an unrelated approach #{int(roll * 1000)}"
+
+    def _respond(self, context, sample=0):
+        prompt = context[-1]["content"] if context else ""
+        puzzle, question = self._puzzle(context)
+        path = self._path(context, question) if puzzle else []
+        if "strict logic grader" in prompt:
+            candidates = re.findall(r"^Step \d+: (.*)$", prompt, re.MULTILINE)
+            if candidates:
+                return "\n".join(f"{i}: {self._grade(puzzle, path, step):.1f}"
+                                 for i, step in enumerate(candidates, 1))
+            return f"{self._grade(puzzle, path[:-1], path[-1] if path else ''):.1f}"
+        if puzzle is None:
+            return "I don't know."
+        if "Instruction:" in prompt:
+            #repeated sequential samples list the earlier ones in the prompt
+            sample += len(re.findall(r"^- ", prompt, re.MULTILINE))
+            return self._expand(puzzle, path, sample)
+        #direct question
+        if self._uniform("flash", puzzle["question"], len(context)) < self.flash_rate:
+            return self._solution(puzzle)
+        return self._wrong_solution(puzzle)
+
+    def _completion(self, text, context, answer_length=None):
+        #the answer stops at answer_length tokens, as the model's would
+        finish_reason = "stop"
+        if answer_length is not None and len(text) > answer_length * 4:
+            text, finish_reason = text[:answer_length * 4], "length"
+        prompt_tokens, completion_tokens = self.count_tokens(context), self._tokens(text)
+        return {"choices": [{"message": {"role": "assistant", "content": text}, "finish_reason": finish_reason}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                          "total_tokens": prompt_tokens + completion_tokens}}
+
+    def cache_prefix(self, messages):
+        pass
+
+    def generate_answer(self, context, answer_length=None, grammar=None, stop=None, seed=None,
+                        phase=None, depth=None, cancel=None, on_token=None, **kwargs):
+        if cancel is not None:
+            cancel.check()
+        start = time.perf_counter()
+        output = self._completion(self._respond(context, sample=seed or 0), context, answer_length)
+        text = output["choices"][0]["message"]["content"]
+        self._record_usage(context, text, "chat", phase, depth, start)
+        if on_token is not None:
+            on_token(text)
+        return output
+
+    def batch_tokens(self, contexts, answer_length=None):
+        if answer_length is None:
+            answer_length = self.answer_length
+        return sum(self.count_tokens(context) for context in contexts) + len(contexts) * answer_length
+
+    def generate_batch(self, contexts, answer_length=None, seed=None, phase=None, depth=None, cancel=None,
+                       **kwargs):
+        outputs = []
+        for i, context in enumerate(contexts):
+            if cancel is not None:
+                cancel.check()
+            start = time.perf_counter()
+            output = self._completion(self._respond(context, sample=(seed or 0) + i), context, answer_length)
+            self._record_usage(context, output["choices"][0]["message"]["content"], "batch", phase, depth, start)
+            outputs.append(output)
+        return outputs
+
+    def score_logprobs(self, context, answer_prefix="", min_mass=0.5, phase=None, depth=None, cancel=None):
+        #the grader answer, read back as an expected score
+        if cancel is not None:
+            cancel.check()
+        start = time.perf_counter()
+        answer = self._respond(context).splitlines()
+        index = answer_prefix.count("\n")
+        self._record_usage(context, answer_prefix, "logprob", phase, depth, start)
+        if index >= len(answer):
+            return None
+        return float(answer[index].split(":")[-1])
@@ -1,27 +1,99 @@
+import threading
+from types import MappingProxyType
+
 class ReasoningNode:
+    #slots keep per-node overhead small in large searches
+    __slots__ = ("content", "role", "parent", "parents", "children", "depth",
+                 "visits", "value", "total_value", "candidates", "breadth", "message")
     def __init__(self, content="", role="assistant",parent=None):
         #node vars
         self.content = content
         self.role = role
         self.parent = parent
+        #equivalent states reached through different paths share one node,
+        #parent is the path the node was first found on, parents holds all of them
+        self.parents = [] if parent is None else [parent]
         self.children = []
         self.depth= 0 if parent is None else parent.depth + 1
         #MCTS+Beam vars
         self.visits=0
         self.value=0.0
         self.total_value=0.0
-        self.history=[]
+        #cached (score, step) expansions, shared by every path reaching this node
+        self.candidates=None
+        #how many samples the candidates were drawn with, a wider beam only adds the difference
+        self.breadth=0
+        #read-only chat message, shared by every context built through this node
+        self.message=MappingProxyType({"role": role, "content": content})
     def add_child(self, content=""):
         child = ReasoningNode(content, role="assistant", parent=self)
         self.children.append(child)
         return child
+    def add_parent(self, parent):
+        self.parents.append(parent)
+        parent.children.append(self)
     def get_history(self):
-        if self.history:
-            return self.history
+        #messages from the root down to this node. built from parent pointers on every call,
+        #so a node shares its ancestors' messages instead of storing its own copy of the path
         history = []
         curr = self
         while curr:
-            history.append({"role":curr.role,"content":curr.content})
+            history.append(curr.message)
             curr = curr.parent
-        self.history= list(reversed(history))
-        return self.history
+        return tuple(reversed(history))
+    def set_content(self, content):
+        self.content = content
+        self.message = MappingProxyType({"role": self.role, "content": content})
+    def prune(self):
+        #drop the text of a branch that fell out of the beam, scores are kept
+        self.set_content("")
+        self.candidates = None
+        self.breadth = 0
+    def is_pruned(self):
+        return self.parent is not None and not self.content
+
+def normalize_step(text):
+    #case, whitespace and trailing punctuation do not change a reasoning state
+    return " ".join(text.lower().split()).rstrip(".!")
+
+class TranspositionTable:
+    #merges equivalent reasoning states across beams, turning the tree into a DAG. a state is the
+    #normalized step, its depth and the set of normalized steps on the path to it, so the same moves
+    #in a different order match. the depth keeps the DAG acyclic: every parent of a merged node sits
+    #one layer above it, so a node can never become its own ancestor
+    def __init__(self):
+        self.scores = {}
+        self.nodes = {}
+        self.lookups = 0
+        self.hits = 0
+        self.merges = 0
+        #while a beam layer is expanded in parallel, lookups read the scores as of the layer start
+        #instead of whichever grades of the other nodes already landed. writes and counters are
+        #serialized, the layer threads share the table
+        self.snapshot = None
+        self.lock = threading.Lock()
+    def key(self, step, parent):
+        path = []
+        curr = parent
+        while curr:
+            path.append(normalize_step(curr.content))
+            curr = curr.parent
+        #only a hash of the path is kept, so keys stay small in deep searches
+        return normalize_step(step), len(path), hash(frozenset(path))
+    def get_score(self, key):
+        with self.lock:
+            self.lookups += 1
+            score = (self.snapshot if self.snapshot is not None else self.scores).get(key)
+            if score is not None:
+                self.hits += 1
+        return score
+    def set_score(self, key, score):
+        with self.lock:
+            self.scores[key] = score
+    def freeze(self):
+        with self.lock:
+            self.snapshot = dict(self.scores)
+    def thaw(self):
+        self.snapshot = None
+    def hit_rate(self):
+        return self.hits / self.lookups if self.lookups else 0.0
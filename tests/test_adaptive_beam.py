@@ -0,0 +1,48 @@
+import os
+
+import pytest
+
+from benchmark import BENCHMARK_DIR, load_corpus
+from search import BeamSearch
+from stub_engine import StubEngine
+from tree import ReasoningNode
+
+CORPUS = load_corpus(os.path.join(BENCHMARK_DIR, "puzzles.jsonl"))
+
+
+def ranked(*totals):
+    #candidates (score, step, parent) sorted by path value, the parent carries none of it
+    parent = ReasoningNode("question", "user")
+    return [(total, f"step: {i}", parent) for i, total in enumerate(totals)]
+
+def make_search(breadth, depth=10):
+    return BeamSearch(engine=StubEngine(), max_breadth=breadth, max_depth=depth, trace_summary=False)
+
+@pytest.mark.parametrize("breadth,width", [(2, 2), (3, 2), (4, 2), (5, 3)])
+def test_narrowed_beam_keeps_a_fallback_path(breadth, width):
+    search = make_search(breadth)
+    _, new_width = search.adapt_beam(ranked(*[1.0] + [0.3] * breadth), depth=0)
+    assert new_width == width
+    assert search.controller["narrowed"] == 1
+
+def test_flat_beam_widens_by_one():
+    search = make_search(3)
+    _, width = search.adapt_beam(ranked(0.8, 0.79, 0.78, 0.77), depth=0)
+    assert width == 4 and search.controller["widened"] == 1
+
+def test_paths_that_cannot_catch_up_are_dropped():
+    #one layer left: a path more than 1.0 behind the leader cannot catch it
+    search = make_search(3, depth=3)
+    hopeful, _ = search.adapt_beam(ranked(2.5, 1.6, 1.4), depth=1)
+    assert [step for _, step, _ in hopeful] == ["step: 0", "step: 1"]
+    assert search.controller["hopeless"] == 1
+
+def test_adaptive_beam_saves_calls_at_the_same_solve_rate():
+    calls, solved = {}, {}
+    for adaptive in (False, True):
+        engine = StubEngine(CORPUS)
+        results = [BeamSearch(engine=engine, adaptive=adaptive, max_depth=7, trace_summary=False).search(p["question"])
+                   for p in CORPUS]
+        calls[adaptive], solved[adaptive] = engine.usage["calls"], sum(1 for result in results if result)
+    assert calls[True] < calls[False]
+    assert solved[True] == solved[False] == len(CORPUS)
@@ -0,0 +1,87 @@
+import asyncio
+import os
+import threading
+
+from async_api import AsyncBeamSearch, AsyncChatEngine, InferenceScheduler
+from benchmark import BENCHMARK_DIR, load_corpus
+from search import BeamSearch, MCTSSearch
+from stub_engine import StubEngine
+
+CORPUS = load_corpus(os.path.join(BENCHMARK_DIR, "puzzles.jsonl"))
+
+
+def test_scheduler_serves_clients_round_robin():
+    scheduler = InferenceScheduler()
+    release = threading.Event()
+    order = []
+    #hold the inference thread until every job is queued
+    blocker = scheduler.submit("blocker", release.wait)
+    jobs = [scheduler.submit(client, order.append, name)
+            for client, name in [("a", "a1"), ("a", "a2"), ("a", "a3"), ("b", "b1")]]
+    release.set()
+    for job in [blocker] + jobs:
+        job.result(timeout=5)
+    scheduler.close()
+    assert order == ["a1", "b1", "a2", "a3"]
+
+def test_concurrent_searches_match_sequential_ones():
+    questions = [puzzle["question"] for puzzle in CORPUS[:4]]
+    expected = [BeamSearch(engine=StubEngine(CORPUS), trace_summary=False).search(q) for q in questions]
+
+    async def run():
+        engine = AsyncChatEngine(StubEngine(CORPUS), max_searches=4)
+        try:
+            return await asyncio.gather(*(AsyncBeamSearch(engine, trace_summary=False).search(q)
+                                          for q in questions))
+        finally:
+            engine.close()
+    assert asyncio.run(run()) == expected
+
+def test_search_events_end_with_the_result():
+    async def run():
+        engine = AsyncChatEngine(StubEngine(CORPUS))
+        try:
+            return [event async for event in
+                    AsyncBeamSearch(engine, search_class=MCTSSearch, trace_summary=False).events(CORPUS[0]["question"])]
+        finally:
+            engine.close()
+    events = asyncio.run(run())
+    names = [name for name, _ in events]
+    assert names[0] == "node_added" and "expanded" in names and "solution" in names
+    assert names[-1] == "done" and events[-1][1]["result"]
+    assert events[-1][1]["usage"]["calls"] > 0
+
+def test_leaving_the_event_stream_cancels_the_search():
+    stub = StubEngine(CORPUS, delay=0.005)
+    async def run():
+        engine = AsyncChatEngine(stub)
+        search = AsyncBeamSearch(engine, trace_summary=False)
+        try:
+            async for name, _ in search.events(CORPUS[0]["question"]):
+                if name == "expanded":
+                    break
+            #long enough for an uncancelled search to finish
+            await asyncio.sleep(0.6)
+            return search
+        finally:
+            engine.close()
+    search = asyncio.run(run())
+    calls = stub.usage["calls"]
+    #the search stopped at its next engine call instead of running to the end
+    assert search.searcher.solved_node is None
+    full = StubEngine(CORPUS)
+    BeamSearch(engine=full, trace_summary=False).search(CORPUS[0]["question"])
+    assert calls < full.usage["calls"]
+
+def test_streamed_pieces_make_up_the_answer():
+    async def run():
+        engine = AsyncChatEngine(StubEngine(CORPUS))
+        context = engine.history + [{"role": "user", "content": CORPUS[0]["question"]}]
+        try:
+            pieces = [piece async for piece in engine.stream(context, temperature=0.7)]
+            answer = await engine.generate_answer(context, temperature=0.7)
+        finally:
+            engine.close()
+        return pieces, answer
+    pieces, answer = asyncio.run(run())
+    assert "".join(pieces) == answer["choices"][0]["message"]["content"]
@@ -0,0 +1,83 @@
+import json
+import os
+import threading
+
+from batch_runner import BatchScheduler, run_batch
+from benchmark import BENCHMARK_DIR, load_corpus
+from stub_engine import StubEngine
+
+CORPUS = load_corpus(os.path.join(BENCHMARK_DIR, "puzzles.jsonl"))
+
+
+class RecordingEngine(StubEngine):
+    #remembers how each call reached the engine
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = []
+
+    def generate_answer(self, context, *args, **kwargs):
+        self.calls.append(("generate_answer", kwargs.get("grammar")))
+        return super().generate_answer(context, *args, **kwargs)
+
+    def generate_batch(self, contexts, *args, **kwargs):
+        self.calls.append(("generate_batch", len(contexts)))
+        return super().generate_batch(contexts, *args, **kwargs)
+
+def context(engine, index):
+    return engine.history + [{"role": "user", "content": CORPUS[index]["question"]}]
+
+def run_together(scheduler, jobs):
+    #one client per job, all calls queued at once so the dispatcher can merge them
+    clients = [scheduler.client() for _ in jobs]
+    results = [None] * len(jobs)
+    def call(i):
+        results[i] = clients[i].generate_answer(*jobs[i][0], **jobs[i][1])
+        clients[i].close()
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(len(jobs))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def test_batches_fit_the_context_window():
+    engine = RecordingEngine(CORPUS)
+    per_call = engine.batch_tokens([context(engine, 0)], 100)
+    #room for two of the four calls in one batch
+    engine.context_length = 2 * per_call + 10
+    scheduler = BatchScheduler(engine, max_wait=1.0)
+    results = run_together(scheduler, [((context(engine, 0),), {"answer_length": 100})] * 4)
+    scheduler.close()
+    assert all(result["choices"][0]["message"]["content"] for result in results)
+    assert sorted(engine.calls) == [("generate_batch", 2), ("generate_batch", 2)]
+    assert scheduler.stats == {"calls": 4, "batches": 2, "batched_calls": 4}
+
+def test_a_call_running_alone_keeps_its_grammar():
+    engine = RecordingEngine(CORPUS)
+    engine.context_length = engine.batch_tokens([context(engine, 0)], 100) + 10
+    scheduler = BatchScheduler(engine, max_wait=1.0)
+    run_together(scheduler, [((context(engine, 0),), {"answer_length": 100, "grammar": "root ::= \"a\""})] * 2)
+    scheduler.close()
+    assert engine.calls == [("generate_answer", "root ::= \"a\"")] * 2
+    assert scheduler.stats["batches"] == 0
+
+def test_only_generation_calls_are_counted():
+    engine = StubEngine(CORPUS)
+    scheduler = BatchScheduler(engine)
+    client = scheduler.client()
+    client.count_tokens(context(engine, 0))
+    client.cache_prefix(context(engine, 0))
+    client.generate_answer(context(engine, 0), answer_length=50)
+    client.close()
+    scheduler.close()
+    assert scheduler.stats["calls"] == 1
+
+def test_run_batch_resumes_where_it_stopped(tmp_path):
+    output = str(tmp_path / "results.jsonl")
+    items = [dict(item) for item in CORPUS[:3]]
+    assert run_batch(StubEngine(CORPUS), items[:2], output, "🤔 Thinking") == {"ok": 2, "error": 0}
+    assert run_batch(StubEngine(CORPUS), items, output, "🤔 Thinking") == {"ok": 1, "error": 0}
+    with open(output, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+    assert sorted(record["id"] for record in records) == sorted(item["id"] for item in items)
+    assert all(record["correct"] for record in records)
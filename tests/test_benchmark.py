@@ -0,0 +1,31 @@
+import json
+import os
+
+import pytest
+
+from benchmark import BENCHMARK_DIR, compare, is_solved, load_corpus, run_mode
+from modes import MODES
+from stub_engine import StubEngine
+
+CORPUS = load_corpus(os.path.join(BENCHMARK_DIR, "puzzles.jsonl"))
+
+with open(os.path.join(BENCHMARK_DIR, "baseline_stub.json"), encoding="utf-8") as f:
+    BASELINE = json.load(f)
+
+
+@pytest.mark.parametrize("mode_name", list(MODES))
+def test_stub_benchmark_does_not_regress(mode_name):
+    #the same check as benchmark.py, without tolerance: the stub is deterministic
+    results = {mode_name: run_mode(StubEngine(CORPUS), mode_name, CORPUS)}
+    assert compare(results, BASELINE, 0.0) == []
+
+def test_stub_runs_are_reproducible():
+    first = run_mode(StubEngine(CORPUS), "🤔 Thinking", CORPUS)
+    second = run_mode(StubEngine(CORPUS), "🤔 Thinking", CORPUS)
+    for metric in ("calls", "prompt_tokens", "completion_tokens", "solve_rate"):
+        assert first[metric] == second[metric]
+
+def test_answers_are_checked_by_substring():
+    puzzle = {"answer": ["4 liters", "5 liter jug"]}
+    assert is_solved(puzzle, "... which leaves 4 LITERS in the 5 liter jug")
+    assert not is_solved(puzzle, "the 5 liter jug holds 6 liters")
@@ -0,0 +1,35 @@
+import os
+
+import pytest
+
+from benchmark import BENCHMARK_DIR, load_corpus
+from search import BeamSearch, MCTSSearch
+from stub_engine import StubEngine
+
+CORPUS = load_corpus(os.path.join(BENCHMARK_DIR, "puzzles.jsonl"))
+PUZZLE = CORPUS[0]
+
+
+@pytest.mark.parametrize("max_calls", [5, 20, 60])
+def test_mcts_stops_at_its_call_budget(max_calls):
+    engine = StubEngine(CORPUS)
+    MCTSSearch(engine=engine, max_calls=max_calls, trace_summary=False).search("an unknown question")
+    #checked between iterations, one iteration expands and grades a single node
+    breadth = 3
+    assert engine.usage["calls"] <= max_calls + 2 * breadth + 1
+
+def test_mcts_stops_at_its_token_budget():
+    engine = StubEngine(CORPUS)
+    MCTSSearch(engine=engine, max_calls=None, max_tokens=3000, trace_summary=False).search(PUZZLE["question"])
+    used = engine.usage["prompt_tokens"] + engine.usage["completion_tokens"]
+    assert used < 3000 + 2000
+
+def test_mcts_solves_with_enough_budget():
+    result = MCTSSearch(engine=StubEngine(CORPUS), max_calls=200, trace_summary=False).search(PUZZLE["question"])
+    assert any(part in result[-1]["content"] for part in PUZZLE["answer"])
+
+def test_beam_search_stops_at_its_call_budget():
+    engine = StubEngine(CORPUS)
+    BeamSearch(engine=engine, max_calls=10, max_retries=3, trace_summary=False).search("an unknown question")
+    #checked between layers, the next layer of at most max_breadth nodes may still run
+    assert engine.usage["calls"] < 10 + 3 * 6
@@ -0,0 +1,106 @@
+import os
+import threading
+
+import pytest
+
+from batch_runner import BatchScheduler
+from benchmark import BENCHMARK_DIR, load_corpus
+from cancellation import CancelToken, SearchCancelled
+from search import BeamSearch, MCTSSearch
+from stub_engine import StubEngine
+
+CORPUS = load_corpus(os.path.join(BENCHMARK_DIR, "puzzles.jsonl"))
+QUESTION = CORPUS[0]["question"]
+
+
+def cancel_after(token, event, count=1):
+    #on_event callback that cancels the token once the event was seen count times
+    seen = []
+    def on_event(name, payload):
+        if name == event:
+            seen.append(name)
+            if len(seen) >= count:
+                token.cancel()
+    return on_event
+
+def test_child_token_follows_its_parent():
+    parent = CancelToken()
+    child = CancelToken(parent)
+    child.cancel()
+    assert child.cancelled() and not parent.cancelled()
+    other = CancelToken(parent)
+    parent.cancel()
+    assert other.cancelled()
+    with pytest.raises(SearchCancelled):
+        other.check()
+
+def test_cancelled_token_stops_the_search_before_any_call():
+    token = CancelToken()
+    token.cancel()
+    engine = StubEngine(CORPUS)
+    with pytest.raises(SearchCancelled):
+        BeamSearch(engine=engine, cancel_token=token, trace_summary=False).search(QUESTION)
+    assert engine.usage["calls"] == 0
+
+@pytest.mark.parametrize("cls", [BeamSearch, MCTSSearch])
+def test_cancel_during_the_search_raises(cls):
+    token = CancelToken()
+    engine = StubEngine(CORPUS)
+    search = cls(engine=engine, cancel_token=token, trace_summary=False, on_event=cancel_after(token, "expanded"))
+    with pytest.raises(SearchCancelled):
+        search.search(QUESTION)
+
+def test_cancel_reaches_a_parallel_layer():
+    token = CancelToken()
+    engine = StubEngine(CORPUS)
+    #the second layer is expanded on three threads
+    search = BeamSearch(engine=engine, cancel_token=token, trace_summary=False, layer_workers=3,
+                        on_event=cancel_after(token, "expanded", 2))
+    with pytest.raises(SearchCancelled):
+        search.search(QUESTION)
+
+def test_parallel_layer_gives_the_sequential_answer():
+    answers = []
+    for workers in (1, 3):
+        search = BeamSearch(engine=StubEngine(CORPUS), trace_summary=False, layer_workers=workers)
+        answers.append([msg["content"] for msg in search.search(QUESTION)])
+    assert answers[0] == answers[1]
+
+def test_batch_scheduler_raises_for_a_cancelled_call():
+    scheduler = BatchScheduler(StubEngine(CORPUS))
+    live, dead = scheduler.client(), scheduler.client()
+    token = CancelToken()
+    token.cancel()
+    context = live.history + [{"role": "user", "content": QUESTION}]
+    results = {}
+    def call(name, client, cancel):
+        try:
+            results[name] = client.generate_answer(context, answer_length=50, cancel=cancel)
+        except SearchCancelled as e:
+            results[name] = e
+    threads = [threading.Thread(target=call, args=("live", live, None)),
+               threading.Thread(target=call, args=("dead", dead, token))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    live.close()
+    dead.close()
+    scheduler.close()
+    assert isinstance(results["dead"], SearchCancelled)
+    assert results["live"]["choices"][0]["message"]["content"]
+
+def test_generate_batch_fallback_lets_cancellation_through():
+    pytest.importorskip("llama_cpp")
+    from chat_engine import ChatEngine
+    #no model is loaded, the batch is made too large for the context so generate_batch falls back
+    engine = ChatEngine.__new__(ChatEngine)
+    engine.answer_length = 100
+    engine.context_length = 150
+    engine._batch_prompts = lambda contexts: ([[0] * 10 for _ in contexts], [0] * len(contexts))
+    def generate_answer(*args, **kwargs):
+        raise SearchCancelled()
+    engine.generate_answer = generate_answer
+    with pytest.raises(SearchCancelled):
+        engine.generate_batch([[{"role": "user", "content": "a"}], [{"role": "user", "content": "b"}]],
+                              cancel=CancelToken())
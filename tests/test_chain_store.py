@@ -0,0 +1,57 @@
+import os
+
+from benchmark import BENCHMARK_DIR, load_corpus
+from chain_store import ChainStore
+from search import BeamSearch
+from stub_engine import StubEngine
+
+CORPUS = load_corpus(os.path.join(BENCHMARK_DIR, "puzzles.jsonl"))
+PUZZLE = CORPUS[0]
+REWORDED = PUZZLE["question"].replace("How do you", "How can you")
+
+
+def solve(engine, store, question):
+    return BeamSearch(engine=engine, chain_store=store, trace_summary=False).search(question)
+
+def test_exact_near_and_missing_lookups(tmp_path):
+    store = ChainStore(str(tmp_path / "chains.sqlite"))
+    store.put(PUZZLE["question"], [("step: a", 0.9), ("solution: b", 0.9)])
+    exact = store.lookup(PUZZLE["question"].upper() + "!")
+    assert exact["match"] == "exact" and exact["steps"] == [("step: a", 0.9), ("solution: b", 0.9)]
+    near = store.lookup(REWORDED)
+    assert near["match"] == "near" and store.threshold <= near["similarity"] < 1
+    assert store.lookup(CORPUS[1]["question"]) is None
+    assert store.stats() == {"exact_hits": 1, "near_hits": 1, "misses": 1, "entries": 1}
+    store.close()
+
+def test_a_repeated_question_costs_no_calls(tmp_path):
+    store = ChainStore(str(tmp_path / "chains.sqlite"))
+    engine = StubEngine(CORPUS)
+    first = solve(engine, store, PUZZLE["question"])
+    calls = engine.usage["calls"]
+    assert first and calls > 0
+    assert solve(engine, store, PUZZLE["question"]) == first
+    assert engine.usage["calls"] == calls
+    store.close()
+
+def test_a_similar_question_only_verifies_the_stored_solution(tmp_path):
+    first = ChainStore(str(tmp_path / "first.sqlite"))
+    engine = StubEngine(CORPUS)
+    searched = solve(engine, first, PUZZLE["question"])
+    calls = engine.usage["calls"]
+    #the same chain, stored for a reworded question only
+    store = ChainStore(str(tmp_path / "chains.sqlite"))
+    store.put(REWORDED, first.lookup(PUZZLE["question"])["steps"])
+    verified = solve(engine, store, PUZZLE["question"])
+    assert verified == searched
+    assert engine.usage["calls"] - calls < calls
+    first.close()
+    store.close()
+
+def test_a_wrong_stored_solution_is_not_reused(tmp_path):
+    store = ChainStore(str(tmp_path / "chains.sqlite"))
+    store.put(REWORDED, [(f"solution: {PUZZLE['wrong']}", 0.9)])
+    result = solve(StubEngine(CORPUS), store, PUZZLE["question"])
+    assert result and PUZZLE["wrong"] not in result[-1]["content"]
+    assert any(part in result[-1]["content"] for part in PUZZLE["answer"])
+    store.close()
@@ -0,0 +1,41 @@
+import itertools
+
+import completion_cache
+from completion_cache import CompletionCache
+
+MESSAGES = [{"role": "user", "content": "2 + 2?"}]
+
+
+def test_key_depends_on_everything_that_decides_the_result(tmp_path):
+    cache = CompletionCache(str(tmp_path / "cache.sqlite"))
+    key = cache.make_key("model", MESSAGES, {"temperature": 0.0, "seed": 1})
+    assert key == cache.make_key("model", [dict(MESSAGES[0])], {"seed": 1, "temperature": 0.0})
+    assert key != cache.make_key("other", MESSAGES, {"temperature": 0.0, "seed": 1})
+    assert key != cache.make_key("model", MESSAGES, {"temperature": 0.0, "seed": 2})
+    assert key != cache.make_key("model", [{"role": "user", "content": "2 + 3?"}], {"temperature": 0.0, "seed": 1})
+    cache.close()
+
+def test_results_persist_across_instances(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = CompletionCache(path)
+    assert cache.get("a") is None
+    cache.put("a", {"choices": [{"message": {"content": "4"}}]})
+    cache.close()
+    cache = CompletionCache(path)
+    assert cache.get("a") == {"choices": [{"message": {"content": "4"}}]}
+    assert cache.stats()["hits"] == 1 and cache.stats()["entries"] == 1
+    cache.close()
+
+def test_least_recently_used_entries_are_evicted(tmp_path, monkeypatch):
+    clock = itertools.count(1)
+    monkeypatch.setattr(completion_cache.time, "time", lambda: next(clock))
+    value = "x" * 100
+    #room for two entries
+    cache = CompletionCache(str(tmp_path / "cache.sqlite"), max_bytes=250)
+    cache.put("a", value)
+    cache.put("b", value)
+    assert cache.get("a") == value
+    cache.put("c", value)
+    assert cache.get("b") is None
+    assert cache.get("a") == value and cache.get("c") == value
+    cache.close()
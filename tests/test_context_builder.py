@@ -0,0 +1,46 @@
+from context_builder import ContextBuilder
+from stub_engine import StubEngine
+
+
+def message(role, words):
+    #the stub counts 4 characters per token, so this message is about 1.25 * words tokens
+    return {"role": role, "content": " ".join(["word"] * words)}
+
+def make_builder(context_length, chunk=4):
+    engine = StubEngine()
+    engine.context_length = context_length
+    return ContextBuilder(engine, chunk=chunk), engine
+
+def test_short_context_is_unchanged():
+    builder, engine = make_builder(4096)
+    history = [message("system", 10)]
+    path = [message("user", 10), message("assistant", 10)]
+    assert builder.build(history, path) == history + path
+    assert builder.trimmed == 0
+
+def test_old_chat_turns_go_first():
+    builder, engine = make_builder(120)
+    system = message("system", 10)
+    history = [system, message("user", 40), message("assistant", 40)]
+    path = [message("user", 20), message("assistant", 20)]
+    context = builder.build(history, path)
+    assert context == [system] + path
+    assert builder.trimmed == 1
+
+def test_oldest_steps_are_dropped_in_chunks():
+    builder, engine = make_builder(150, chunk=4)
+    system, problem = message("system", 5), message("user", 5)
+    steps = [{"role": "assistant", "content": f"step {i}: " + " ".join(["word"] * 10)} for i in range(12)]
+    context = builder.build([system], [problem] + steps, reserve=50)
+    assert context[:2] == [system, problem]
+    omitted = int(context[2]["content"].split("(")[1].split()[0])
+    assert omitted % 4 == 0
+    assert context[3:] == steps[omitted:]
+    assert engine.count_tokens(context) <= 150 - 50
+
+def test_problem_and_last_step_always_stay():
+    builder, engine = make_builder(50)
+    problem = message("user", 5)
+    steps = [message("assistant", 30) for _ in range(3)]
+    context = builder.build([message("system", 5)], [problem] + steps)
+    assert context[1] is problem and context[-1] is steps[-1]
@@ -0,0 +1,43 @@
+import json
+
+from metrics import Histogram, MetricsRegistry, Tracer
+
+
+def test_histogram_percentiles_stay_within_the_observed_range():
+    histogram = Histogram(start=1)
+    for value in range(1, 101):
+        histogram.observe(value)
+    assert histogram.count == 100 and histogram.mean() == 50.5
+    assert histogram.percentile(0.5) == 64
+    assert histogram.percentile(0.99) == 100
+    assert histogram.percentile(0.0) == 1
+    assert Histogram().percentile(0.5) == 0.0
+
+def test_registry_splits_calls_by_phase():
+    registry = MetricsRegistry()
+    registry.record({"phase": "expand", "sequences": 3, "prompt_tokens": 10, "latency_s": 0.2})
+    registry.record({"phase": "grade", "cache_hit": True, "cached_tokens": 8, "latency_s": None})
+    registry.record({"phase": "grade", "draft_tokens": 4, "accepted_tokens": 3})
+    assert registry.counters[("calls", "expand")] == 3
+    assert registry.counters[("calls", "grade")] == 2
+    assert registry.counters[("cache_hits", "grade")] == 1
+    assert registry.counters[("cached_tokens", "grade")] == 8
+    assert ("latency_s", "grade") not in registry.histograms
+    assert registry.phases() == ["expand", "grade"]
+    lines = registry.summary().splitlines()
+    assert len(lines) == 3 and "75%" in lines[2]
+
+def test_collect_only_sees_calls_inside_the_block(tmp_path):
+    path = tmp_path / "trace.jsonl"
+    tracer = Tracer(str(path))
+    tracer.record(phase="expand")
+    with tracer.collect() as registry:
+        tracer.record(phase="grade")
+    tracer.record(phase="grade")
+    tracer.close()
+    assert registry.phases() == ["grade"]
+    assert registry.counters[("calls", "grade")] == 1
+    assert tracer.registry.counters[("calls", "grade")] == 2
+    calls = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [call["phase"] for call in calls] == ["expand", "grade", "grade"]
+    assert all("ts" in call for call in calls)
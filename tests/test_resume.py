@@ -0,0 +1,19 @@
+import os
+
+from benchmark import BENCHMARK_DIR, load_corpus
+from search import BeamSearch
+from stub_engine import StubEngine
+
+CORPUS = load_corpus(os.path.join(BENCHMARK_DIR, "puzzles.jsonl"))
+PUZZLE = CORPUS[0]
+
+
+def test_a_resumed_retry_reuses_the_first_attempt():
+    calls, results = {}, {}
+    for resume in (False, True):
+        engine = StubEngine(CORPUS)
+        search = BeamSearch(engine=engine, max_depth=2, max_retries=1, resume=resume, trace_summary=False)
+        results[resume] = search.search(PUZZLE["question"])
+        calls[resume] = engine.usage["calls"]
+    assert results[True] and results[False]
+    assert calls[True] < calls[False]
@@ -0,0 +1,26 @@
+import os
+
+import pytest
+
+from benchmark import BENCHMARK_DIR, load_corpus
+from modes import MODES, make_searcher
+from stub_engine import StubEngine
+
+CORPUS = load_corpus(os.path.join(BENCHMARK_DIR, "puzzles.jsonl"))
+SEARCH_MODES = [name for name, config in MODES.items() if config["type"] != "direct"]
+
+
+@pytest.mark.parametrize("mode_name", SEARCH_MODES)
+def test_solved_search_returns_plain_messages(mode_name):
+    search = make_searcher(MODES[mode_name], StubEngine(CORPUS), trace_summary=False)
+    result = search.search(CORPUS[0]["question"])
+    assert type(result) is list and result
+    assert all(type(msg) is dict for msg in result)
+    assert result[0] == {"role": "user", "content": CORPUS[0]["question"]}
+    result[-1]["content"] += " (edited)"
+
+@pytest.mark.parametrize("mode_name", SEARCH_MODES)
+def test_failed_search_returns_an_empty_list(mode_name):
+    #the stub has no script for this question, so no step is ever verified
+    search = make_searcher(MODES[mode_name], StubEngine(CORPUS), trace_summary=False)
+    assert search.search("What is the colour of the number seven?") == []
@@ -0,0 +1,74 @@
+import json
+import os
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from benchmark import BENCHMARK_DIR, load_corpus
+from modes import MODES
+from server import ReasoningServer, RequestError, resolve_mode
+from stub_engine import StubEngine
+
+CORPUS = load_corpus(os.path.join(BENCHMARK_DIR, "puzzles.jsonl"))
+QUESTION = CORPUS[0]["question"]
+
+
+@pytest.fixture
+def server():
+    server = ReasoningServer(("127.0.0.1", 0), StubEngine(CORPUS), max_calls=50, max_tokens=20000)
+    yield server
+    server.close()
+
+@pytest.fixture
+def running(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+
+def post(server, path, body):
+    request = urllib.request.Request(f"http://127.0.0.1:{server.server_address[1]}{path}",
+                                     data=json.dumps(body).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+@pytest.mark.parametrize("value", [True, False, 0, -3, 2.5, "10"])
+@pytest.mark.parametrize("name", ["max_calls", "max_tokens"])
+def test_budget_rejects_anything_but_positive_integers(server, name, value):
+    with pytest.raises(RequestError):
+        server.budget({name: value}, MODES[resolve_mode("thinking")])
+
+def test_budget_defaults_to_the_preset_and_is_capped(server):
+    mcts = MODES[resolve_mode("mcts")]
+    assert server.budget({}, mcts) == {"max_calls": min(mcts["budget"], 50), "max_tokens": 20000}
+    assert server.budget({"max_calls": 10 ** 6, "max_tokens": 10 ** 9}, mcts) == {"max_calls": 50, "max_tokens": 20000}
+    assert server.budget({"max_calls": 7, "max_tokens": 100}, mcts) == {"max_calls": 7, "max_tokens": 100}
+
+def test_boolean_budget_is_a_bad_request(running):
+    status, payload = post(running, "/v1/reasoning", {"question": QUESTION, "mode": "thinking", "max_calls": True})
+    assert status == 400
+    status, payload = post(running, "/v1/chat/completions",
+                           {"model": "flash", "messages": [{"role": "user", "content": QUESTION}], "max_tokens": True})
+    assert status == 400
+
+def test_direct_answer_length_follows_max_tokens(running):
+    status, full = post(running, "/v1/reasoning", {"question": QUESTION, "mode": "flash"})
+    assert status == 200 and len(full["answer"]) > 4
+    status, short = post(running, "/v1/reasoning", {"question": QUESTION, "mode": "flash", "max_tokens": 1})
+    assert status == 200
+    assert short["answer"] == full["answer"][:4]
+    assert short["usage"]["completion_tokens"] <= 2
+
+def test_search_stays_within_its_call_budget(running):
+    status, free = post(running, "/v1/reasoning", {"question": QUESTION, "mode": "thinking"})
+    assert status == 200
+    status, capped = post(running, "/v1/reasoning", {"question": QUESTION, "mode": "thinking", "max_calls": 3})
+    assert status == 200
+    #the budget is checked between layers, so a search can overshoot it by up to one layer
+    assert capped["usage"]["calls"] < free["usage"]["calls"]
@@ -0,0 +1,42 @@
+from step_filter import StepFilter, similarity
+from tree import ReasoningNode
+
+
+def make_path(*steps):
+    node = ReasoningNode("question", "user")
+    for step in steps:
+        node = node.add_child(step)
+    return node
+
+def test_similarity_ignores_case_punctuation_and_prefix():
+    assert similarity("step: Fill the 5 liter jug.", "idea: fill the 5 liter jug") == 1.0
+    assert similarity("step: fill the 5 liter jug", "step: empty the 3 liter jug into the sink") == 0.0
+
+def test_malformed_steps_get_the_invalid_score():
+    step_filter = StepFilter()
+    accepted, rejected = step_filter.filter(make_path(), ["fill the jug", "step: fill the jug", "SOLVED"])
+    assert accepted == ["step: fill the jug", "SOLVED"]
+    assert rejected == {"fill the jug": step_filter.invalid_score}
+    assert step_filter.rejected == {"format": 1, "duplicate": 0}
+
+def test_restated_ancestors_and_siblings_are_duplicates():
+    step_filter = StepFilter()
+    node = make_path("step: fill the 5 liter jug and pour it into the 3 liter jug")
+    steps = ["step: Fill the 5 liter jug and pour it into the 3 liter jug.",
+             "step: empty the 3 liter jug and pour the 2 liters into it",
+             "idea: empty the 3 liter jug and pour the 2 liters into it"]
+    accepted, rejected = step_filter.filter(node, steps)
+    assert accepted == [steps[1]]
+    assert set(rejected) == {steps[0], steps[2]}
+    assert all(score == step_filter.duplicate_score for score in rejected.values())
+    assert step_filter.saved_calls() == 2
+
+def test_graded_siblings_count_as_neighbours():
+    step_filter = StepFilter()
+    accepted, rejected = step_filter.filter(make_path(), ["step: weigh three coins against three"],
+                                            siblings=["step: weigh three coins against three."])
+    assert accepted == [] and len(rejected) == 1
+
+def test_solved_is_never_a_duplicate():
+    accepted, _ = StepFilter().filter(make_path("SOLVED"), ["SOLVED"])
+    assert accepted == ["SOLVED"]
@@ -0,0 +1,61 @@
+from search import BeamSearch, MCTSSearch
+from stub_engine import StubEngine
+from tree import ReasoningNode, TranspositionTable
+
+
+def make_search(cls=BeamSearch):
+    search = cls(engine=StubEngine(), trace_summary=False)
+    search.root = ReasoningNode("question", "user")
+    search.transpositions = TranspositionTable()
+    return search
+
+def add_path(search, steps):
+    node = search.root
+    for step in steps:
+        node = search.add_state(node, step, 0.5)
+    return node
+
+def test_same_moves_in_another_order_merge():
+    search = make_search()
+    first = add_path(search, ["step: fill A", "step: fill B", "step: pour B into A"])
+    second = add_path(search, ["Step: fill B.", "step: fill A", "step: pour B into A"])
+    assert first is second
+    assert len(first.parents) == 2
+    assert search.transpositions.merges == 1
+
+def test_merged_state_reuses_its_grade():
+    search = make_search()
+    a_then_b = add_path(search, ["step: fill A", "step: fill B"])
+    b_then_a = add_path(search, ["step: fill B", "step: fill A"])
+    assert a_then_b is not b_then_a
+    table = search.transpositions
+    table.set_score(table.key("step: pour B into A", a_then_b), 0.9)
+    assert table.get_score(table.key("step: pour B into A", b_then_a)) == 0.9
+    assert table.hits == 1
+
+def test_different_paths_do_not_merge():
+    search = make_search()
+    first = add_path(search, ["step: fill A", "step: pour A into B"])
+    second = add_path(search, ["step: fill B", "step: pour A into B"])
+    assert first is not second
+    assert search.transpositions.merges == 0
+
+def test_repeated_moves_never_form_a_cycle():
+    search = make_search()
+    add_path(search, ["step: a", "step: b", "step: c"])
+    leaf = add_path(search, ["step: b", "step: a", "step: c", "step: a", "step: b", "step: c"])
+    assert search.transpositions.merges == 1
+    assert leaf.depth == 6
+    #every parent of a node is one layer above it, so walking up always reaches the root
+    stack = [leaf]
+    while stack:
+        node = stack.pop()
+        assert all(parent.depth == node.depth - 1 for parent in node.parents)
+        stack.extend(node.parents)
+
+def test_mcts_merges_too():
+    search = make_search(MCTSSearch)
+    first = add_path(search, ["step: fill A", "step: fill B", "step: done"])
+    second = add_path(search, ["step: fill B", "step: fill A", "step: done"])
+    assert first is second
+    assert search.transpositions.merges == 1